@@ -1,21 +1,185 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request, g, stream_with_context
 from flask_cors import CORS
+import click
 import os
+import time
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///books.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///books.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+app.config['RECOMMENDER_RETRAIN_INTERVAL'] = int(os.environ.get('RECOMMENDER_RETRAIN_INTERVAL', 3600))
+app.config['RECOMMENDER_RETRAIN_AFTER_RATINGS'] = int(os.environ.get('RECOMMENDER_RETRAIN_AFTER_RATINGS', 100))
+app.config['RECOMMENDER_SNAPSHOT_PATH'] = os.environ.get(
+    'RECOMMENDER_SNAPSHOT_PATH', os.path.join(app.instance_path, 'recommender_snapshot')
+)
+app.config['RECOMMENDER_SNAPSHOT_POLL_INTERVAL'] = int(os.environ.get('RECOMMENDER_SNAPSHOT_POLL_INTERVAL', 30))
+app.config['RECOMMENDER_COLLABORATIVE'] = os.environ.get('RECOMMENDER_COLLABORATIVE', 'user')
+app.config['RECOMMENDER_FACTORIZATION'] = os.environ.get('RECOMMENDER_FACTORIZATION', 'als')
+app.config['RECOMMENDER_FACTORS'] = int(os.environ.get('RECOMMENDER_FACTORS', 32))
+app.config['RECOMMENDER_CONTENT_VECTORIZER'] = os.environ.get('RECOMMENDER_CONTENT_VECTORIZER', 'tfidf')
+app.config['RECOMMENDER_FUSION'] = os.environ.get('RECOMMENDER_FUSION', 'score')
+app.config['RECOMMENDER_JOBS'] = int(os.environ.get('RECOMMENDER_JOBS', os.cpu_count() or 1))
+app.config['RECOMMENDER_BLOCK_SIZE'] = int(os.environ.get('RECOMMENDER_BLOCK_SIZE', 1024))
+app.config['RESPONSE_CACHE_SIZE'] = int(os.environ.get('RESPONSE_CACHE_SIZE', 10000))
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') != '0'
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR')
 CORS(app)
 
+from metrics import registry as metrics_registry, CACHE_REQUESTS, HTTP_REQUEST_SECONDS
+metrics_registry.enabled = app.config['METRICS_ENABLED']
+
+# Optionally write a cProfile dump per request (view with snakeviz or pstats)
+if app.config['PROFILE_DIR']:
+    from werkzeug.middleware.profiler import ProfilerMiddleware
+    os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, profile_dir=app.config['PROFILE_DIR'])
+
 # Import models and initialize db
 from models import db, Book, User, Rating
 db.init_app(app)
 
-from recommendation_engine import HybridRecommender
+from model_service import RecommenderService
+from response_cache import ResponseCache, make_etag
+from rating_ingest import ingest_ratings, iter_rating_events, open_text_stream
+from listing import (
+    ListingError,
+    fetch_page,
+    iter_json_array,
+    iter_ndjson,
+    iter_rows,
+    parse_fields,
+    parse_page_args
+)
+from precompute import (
+    get_precomputed_recommendations,
+    invalidate_precomputed_recommendations,
+    precompute_recommendations
+)
+
+# Recommendation engine, retrained in the background and swapped atomically
+recommender_service = RecommenderService(
+    app,
+    retrain_interval=app.config['RECOMMENDER_RETRAIN_INTERVAL'],
+    retrain_after_ratings=app.config['RECOMMENDER_RETRAIN_AFTER_RATINGS'],
+    snapshot_path=app.config['RECOMMENDER_SNAPSHOT_PATH'] or None,
+    snapshot_poll_interval=app.config['RECOMMENDER_SNAPSHOT_POLL_INTERVAL'],
+    model_options={
+        'collaborative': app.config['RECOMMENDER_COLLABORATIVE'],
+        'factorization': app.config['RECOMMENDER_FACTORIZATION'],
+        'n_factors': app.config['RECOMMENDER_FACTORS'],
+        'content_vectorizer': app.config['RECOMMENDER_CONTENT_VECTORIZER'],
+        'fusion': app.config['RECOMMENDER_FUSION'],
+        'n_jobs': app.config['RECOMMENDER_JOBS'],
+        'block_size': app.config['RECOMMENDER_BLOCK_SIZE']
+    }
+)
+
+# Computed recommendation and similar-book results; entries are keyed on the
+# model version (and the user's rating version) and dropped on every model swap
+response_cache = ResponseCache(
+    max_entries=app.config['RESPONSE_CACHE_SIZE'],
+    ttl=app.config['RESPONSE_CACHE_TTL']
+)
+recommender_service.add_swap_listener(lambda model: response_cache.clear())
+
+def model_warming_up():
+    """Response returned while the first recommendation model is training"""
+    response = jsonify({'error': 'Recommendation model is warming up, please retry shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
 
-# Initialize recommendation engine (will be trained after DB init)
-recommender = None
+def conditional_json(payload, etag):
+    """JSON response with an ETag, or 304 Not Modified if the client has it"""
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def serialize_books(book_ids, recommender=None):
+    """Book details for ``book_ids`` in order, from the catalog cache when available"""
+    if recommender is not None:
+        return recommender.catalog.get_many(book_ids)
+    books = {book.id: book.to_dict() for book in Book.query.filter(Book.id.in_(book_ids))}
+    return [books[book_id] for book_id in book_ids if book_id in books]
+
+def parse_book_filters(genres=(), authors=(), min_year=None, max_year=None):
+    """
+    Book filter keyword arguments for the recommender from request values;
+    raises ValueError for a year that is not an integer
+    """
+    filters = {}
+    if genres:
+        filters['genres'] = tuple(genres)
+    if authors:
+        filters['authors'] = tuple(authors)
+    if min_year not in (None, ''):
+        filters['min_year'] = int(min_year)
+    if max_year not in (None, ''):
+        filters['max_year'] = int(max_year)
+    return filters
+
+def request_book_filters():
+    """Book filters from the genre/author (repeatable), min_year and max_year query parameters"""
+    return parse_book_filters(
+        request.args.getlist('genre'), request.args.getlist('author'),
+        request.args.get('min_year'), request.args.get('max_year')
+    )
+
+def list_resource(model, collection):
+    """
+    Listing shared by /api/books and /api/users.
+    
+    With ``limit`` and/or ``after`` returns one keyset page as
+    ``{collection: [...], 'next_after': id}`` with an ETag; with
+    ``format=ndjson`` streams every row after ``after`` as JSON Lines; and
+    otherwise streams the full list as a JSON array. ``fields`` restricts the
+    returned fields in every mode.
+    """
+    fmt = request.args.get('format', 'json')
+    if fmt not in ('json', 'ndjson'):
+        return jsonify({'error': 'format must be json or ndjson'}), 400
+    try:
+        fields = parse_fields(model, request.args.get('fields'))
+        after, limit = parse_page_args(request.args)
+    except ListingError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if fmt == 'ndjson':
+        rows = iter_rows(model, fields, after)
+        return Response(stream_with_context(iter_ndjson(rows)), mimetype='application/x-ndjson')
+    if 'limit' not in request.args and 'after' not in request.args:
+        # Unpaginated: stream the list instead of building it in memory
+        rows = iter_rows(model, fields)
+        return Response(stream_with_context(iter_json_array(rows)), mimetype='application/json')
+    
+    items, next_after = fetch_page(model, fields, after, limit)
+    return conditional_json(
+        {collection: items, 'next_after': next_after},
+        make_etag(collection, [field for field, _ in fields], after, limit, items)
+    )
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            endpoint=endpoint, method=request.method, status=str(response.status_code)
+        )
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics for the recommender and the API"""
+    return metrics_registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 @app.route('/')
 def index():
@@ -23,55 +187,71 @@ def index():
 
 @app.route('/api/books', methods=['GET'])
 def get_books():
-    """Get all books"""
-    books = Book.query.all()
-    return jsonify([{
-        'id': book.id,
-        'title': book.title,
-        'author': book.author,
-        'genre': book.genre,
-        'description': book.description,
-        'year': book.year,
-        'rating': book.average_rating
-    } for book in books])
+    """List books; see list_resource() for pagination, fields and streaming"""
+    return list_resource(Book, 'books')
 
 @app.route('/api/books/<int:book_id>', methods=['GET'])
 def get_book(book_id):
     """Get a specific book"""
     book = Book.query.get_or_404(book_id)
-    return jsonify({
-        'id': book.id,
-        'title': book.title,
-        'author': book.author,
-        'genre': book.genre,
-        'description': book.description,
-        'year': book.year,
-        'rating': book.average_rating
-    })
+    return jsonify(book.to_dict())
 
 @app.route('/api/users/<int:user_id>/recommendations', methods=['GET'])
 def get_recommendations(user_id):
-    """Get personalized recommendations for a user"""
-    global recommender
-    user = User.query.get_or_404(user_id)
+    """
+    Get personalized recommendations for a user, optionally only books of the
+    given genre(s)/author(s) and published between min_year and max_year
+    """
+    n_recommendations, alpha = 10, 0.5
+    try:
+        filters = request_book_filters()
+    except ValueError:
+        return jsonify({'error': 'min_year and max_year must be valid integers'}), 400
     
-    # Initialize recommender if not already done
-    if recommender is None:
-        recommender = HybridRecommender()
-        recommender.train()
+    # Read the versions before the model so a concurrent swap or rating can
+    # only make the cache key older, never newer, than the result
+    cache_key = (('user', user_id), n_recommendations, alpha, tuple(sorted(filters.items())),
+                 recommender_service.model_version, recommender_service.rating_version(user_id))
+    recommender = recommender_service.get_model()
     
-    # Get hybrid recommendations
-    recommendations = recommender.get_hybrid_recommendations(user_id, n_recommendations=10)
+    book_ids = response_cache.get(cache_key) if recommender is not None else None
+    if book_ids is None:
+        user = User.query.get_or_404(user_id)
+        
+        # Serve the list stored by the offline precompute job when there is
+        # one; precomputed lists are unfiltered
+        book_ids = None
+        if not filters:
+            book_ids = get_precomputed_recommendations(user_id, n_recommendations=n_recommendations, alpha=alpha)
+            CACHE_REQUESTS.inc(cache='precomputed', result='miss' if book_ids is None else 'hit')
+        if book_ids is None:
+            if recommender is None:
+                return model_warming_up()
+            
+            # Get hybrid recommendations
+            recommendations = recommender.get_hybrid_recommendations(
+                user_id, n_recommendations=n_recommendations, alpha=alpha, filters=filters
+            )
+            book_ids = [book['id'] for book in recommendations]
+        
+        if recommender is None:
+            return jsonify({
+                'user_id': user_id,
+                'recommendations': serialize_books(book_ids)
+            })
+        response_cache.set(cache_key, book_ids)
     
-    return jsonify({
+    # Book details always come from the live catalog, so only the ids are
+    # cached; the ETag covers the details actually returned
+    books = serialize_books(book_ids, recommender)
+    return conditional_json({
         'user_id': user_id,
-        'recommendations': recommendations
-    })
+        'recommendations': books
+    }, make_etag(cache_key, books))
 
 @app.route('/api/users/<int:user_id>/rate', methods=['POST'])
 def rate_book(user_id):
     """Rate a book"""
-    global recommender
     data = request.json
     book_id = data.get('book_id')
     rating_value = data.get('rating')
@@ -92,54 +272,221 @@ def rate_book(user_id):
     
     # Check if rating already exists
     existing_rating = Rating.query.filter_by(user_id=user_id, book_id=book_id).first()
+    old_rating_value = None
     if existing_rating:
+        old_rating_value = existing_rating.rating
         existing_rating.rating = rating_value
     else:
         rating = Rating(user_id=user_id, book_id=book_id, rating=rating_value)
         db.session.add(rating)
     
+    # Update book's running average and drop the user's stale precomputed
+    # recommendations in the same transaction
+    book.apply_rating_change(old_rating_value, rating_value)
+    invalidate_precomputed_recommendations([user_id])
     db.session.commit()
     
-    # Update book's average rating
-    book.update_average_rating()
-    
-    # Note: Recommender retraining is deferred for performance.
-    # In production, consider batch retraining or incremental updates.
-    # For now, recommendations will be stale until next app restart.
+    # Apply the rating to the live model incrementally; a full retrain
+    # runs in the background once enough new ratings have accumulated
+    recommender_service.record_rating(user_id, book_id, rating_value)
+    response_cache.invalidate(('user', user_id))
     
     return jsonify({'message': 'Rating saved successfully'})
 
+@app.route('/api/recommendations/batch', methods=['POST'])
+def get_batch_recommendations():
+    """Get recommendations for many users in one request"""
+    data = request.json or {}
+    user_ids = data.get('user_ids')
+    if not isinstance(user_ids, list) or not user_ids:
+        return jsonify({'error': 'user_ids must be a non-empty list'}), 400
+    if len(user_ids) > 1000:
+        return jsonify({'error': 'at most 1000 user_ids per request'}), 400
+    
+    try:
+        user_ids = [int(user_id) for user_id in user_ids]
+        n_recommendations = int(data.get('n', 10))
+        alpha = float(data.get('alpha', 0.5))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'user_ids and n must be integers and alpha a number'}), 400
+    genres, authors = data.get('genre') or [], data.get('author') or []
+    try:
+        filters = parse_book_filters(
+            [genres] if isinstance(genres, str) else genres,
+            [authors] if isinstance(authors, str) else authors,
+            data.get('min_year'), data.get('max_year')
+        )
+    except (ValueError, TypeError):
+        return jsonify({'error': 'min_year and max_year must be valid integers'}), 400
+    if n_recommendations < 1 or n_recommendations > 100 or not 0 <= alpha <= 1:
+        return jsonify({'error': 'n must be between 1 and 100 and alpha between 0 and 1'}), 400
+    
+    recommender = recommender_service.get_model()
+    if recommender is None:
+        return model_warming_up()
+    
+    recommendations = recommender.get_batch_recommendations(
+        user_ids, n_recommendations=n_recommendations, alpha=alpha, filters=filters
+    )
+    
+    return jsonify({
+        'recommendations': {
+            str(user_id): recommender.catalog.get_many(book_ids)
+            for user_id, book_ids in recommendations.items()
+        }
+    })
+
+@app.route('/api/ratings/bulk', methods=['POST'])
+def bulk_rate_books():
+    """
+    Bulk upsert ratings streamed as JSON Lines (default) or CSV.
+    
+    Use ?format=csv or a text/csv body for CSV with a user_id,book_id,rating
+    header. The body is processed in batches without being loaded into memory.
+    """
+    fmt = request.args.get('format')
+    if fmt is None:
+        fmt = 'csv' if request.mimetype == 'text/csv' else 'jsonl'
+    if fmt not in ('jsonl', 'csv'):
+        return jsonify({'error': 'format must be jsonl or csv'}), 400
+    
+    try:
+        batch_size = int(request.args.get('batch_size', 5000))
+    except ValueError:
+        return jsonify({'error': 'batch_size must be a valid integer'}), 400
+    batch_size = min(max(batch_size, 1), 10000)
+    
+    events = iter_rating_events(open_text_stream(request.stream), fmt)
+    summary = ingest_ratings(events, batch_size=batch_size)
+    
+    # Refresh the model once for the whole import; cached lists may have
+    # come from precomputed rows the import just invalidated
+    if summary['upserted']:
+        response_cache.clear()
+        recommender_service.request_retrain()
+    
+    return jsonify(summary)
+
 @app.route('/api/users', methods=['GET'])
 def get_users():
-    """Get all users"""
-    users = User.query.all()
-    return jsonify([{
-        'id': user.id,
-        'username': user.username
-    } for user in users])
+    """List users; see list_resource() for pagination, fields and streaming"""
+    return list_resource(User, 'users')
 
 @app.route('/api/similar/<int:book_id>', methods=['GET'])
 def get_similar_books(book_id):
-    """Get books similar to a given book"""
-    global recommender
-    book = Book.query.get_or_404(book_id)
-    
-    # Initialize recommender if not already done
+    """Get books similar to a given book, optionally filtered like recommendations"""
+    n_recommendations = 5
+    try:
+        filters = request_book_filters()
+    except ValueError:
+        return jsonify({'error': 'min_year and max_year must be valid integers'}), 400
+    model_version = recommender_service.model_version
+    recommender = recommender_service.get_model()
     if recommender is None:
-        recommender = HybridRecommender()
-        recommender.train()
+        return model_warming_up()
     
-    similar_books = recommender.get_similar_books(book_id, n_recommendations=5)
+    # Neighbour lists only change with the model or the content index
+    cache_key = (('book', book_id), n_recommendations, tuple(sorted(filters.items())),
+                 model_version, recommender.content_version)
+    similar = response_cache.get(cache_key)
+    if similar is None:
+        # Books are served from the model's catalog cache; only fall back to the
+        # database to tell a 404 from a book that is not cached yet
+        if book_id not in recommender.catalog:
+            Book.query.get_or_404(book_id)
+        
+        similar = [
+            (book['id'], book['similarity'])
+            for book in recommender.get_similar_books(book_id, n_recommendations=n_recommendations, filters=filters)
+        ]
+        response_cache.set(cache_key, similar)
     
-    return jsonify({
+    # Book details always come from the live catalog, so only ids and
+    # similarities are cached; the ETag covers the details actually returned
+    similarities = dict(similar)
+    similar_books = [
+        dict(book, similarity=similarities[book['id']])
+        for book in serialize_books([similar_id for similar_id, _ in similar], recommender)
+    ]
+    return conditional_json({
         'book_id': book_id,
         'similar_books': similar_books
-    })
+    }, make_etag(cache_key, similar_books))
+
+@app.cli.command('import-ratings')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']),
+              help='Input format (default: from the file extension, else jsonl)')
+@click.option('--batch-size', default=5000, show_default=True, type=click.IntRange(min=1),
+              help='Ratings per transaction')
+def import_ratings_command(source, fmt, batch_size):
+    """Bulk import ratings from a JSON Lines or CSV file ('-' for stdin)"""
+    if fmt is None:
+        fmt = 'csv' if source.name.endswith('.csv') else 'jsonl'
+    
+    summary = ingest_ratings(iter_rating_events(source, fmt), batch_size=batch_size)
+    click.echo(f"Received {summary['received']}, upserted {summary['upserted']}, "
+               f"rejected {summary['rejected']} in {summary['batches']} batches")
+    for error in summary['errors']:
+        click.echo(f"  line {error['line']}: {error['error']}", err=True)
+    
+    # Retrain once for the whole import. Running servers cannot be reached
+    # from here; they map the new snapshot at their next poll
+    if summary['upserted']:
+        if not recommender_service.snapshot_path:
+            click.echo("No snapshot path configured: running servers pick up the imported "
+                       "ratings at their next scheduled retrain")
+            return
+        recommender_service.retrain(wait=True)
+        click.echo(f"Saved a retrained model to {recommender_service.snapshot_path}; running servers "
+                   f"load it within {recommender_service.snapshot_poll_interval} seconds")
+
+@app.cli.command('precompute-recommendations')
+@click.option('--n', 'n_recommendations', default=20, show_default=True, help='Recommendations stored per user')
+@click.option('--alpha', default=0.5, show_default=True, help='Weight for collaborative filtering')
+@click.option('--batch-size', default=1000, show_default=True, help='Users per batch')
+def precompute_recommendations_command(n_recommendations, alpha, batch_size):
+    """Precompute top-N recommendations for every user (e.g. nightly)"""
+    recommender = recommender_service.load_or_train()
+    written = precompute_recommendations(
+        recommender, n_recommendations=n_recommendations, alpha=alpha, batch_size=batch_size
+    )
+    click.echo(f"Precomputed recommendations for {written} users")
+
+def upgrade_db():
+    """Add columns and indexes introduced after a database was first created"""
+    inspector = db.inspect(db.engine)
+    
+    book_columns = {column['name'] for column in inspector.get_columns('book')}
+    if 'rating_count' not in book_columns:
+        with db.engine.begin() as connection:
+            connection.execute(db.text("ALTER TABLE book ADD COLUMN rating_sum INTEGER NOT NULL DEFAULT 0"))
+            connection.execute(db.text("ALTER TABLE book ADD COLUMN rating_count INTEGER NOT NULL DEFAULT 0"))
+        print("Database upgraded with rating aggregate columns")
+    
+    rating_indexes = {index['name'] for index in inspector.get_indexes('rating')}
+    if 'ix_rating_book_id' not in rating_indexes:
+        with db.engine.begin() as connection:
+            connection.execute(db.text("CREATE INDEX ix_rating_book_id ON rating (book_id)"))
+        print("Database upgraded with rating book_id index")
+    
+    rating_columns = {column['name'] for column in inspector.get_columns('rating')}
+    if 'updated_at' not in rating_columns:
+        with db.engine.begin() as connection:
+            connection.execute(db.text("ALTER TABLE rating ADD COLUMN updated_at TIMESTAMP"))
+            connection.execute(db.text("UPDATE rating SET updated_at = created_at"))
+            connection.execute(db.text("CREATE INDEX ix_rating_updated_at ON rating (updated_at)"))
+        print("Database upgraded with rating updated_at column")
+    
+    if 'rating_count' not in book_columns:
+        Book.recalculate_average_ratings()
+        db.session.commit()
 
 def init_db():
     """Initialize the database with sample data"""
     with app.app_context():
         db.create_all()
+        upgrade_db()
         
         # Check if data already exists
         if Book.query.count() > 0:
@@ -209,19 +556,16 @@ def init_db():
         db.session.commit()
         
         # Update average ratings
-        for book in books:
-            book.update_average_rating()
+        Book.recalculate_average_ratings()
+        db.session.commit()
         
         print("Database initialized with sample data")
-        
-        # Train the recommender
-        global recommender
-        recommender = HybridRecommender()
-        recommender.train()
-        print("Recommendation engine trained")
 
 if __name__ == '__main__':
     init_db()
+    # Warm the recommender before serving and keep it fresh in the background
+    recommender_service.start()
+    print("Recommendation engine trained")
     # Use debug mode only in development, never in production
     debug_mode = os.environ.get('FLASK_ENV') == 'development'
     app.run(debug=debug_mode, host='0.0.0.0', port=5000)
@@ -0,0 +1,316 @@
+"""
+Benchmark suite for the recommendation engine on synthetic data.
+
+Generates a seeded synthetic catalog (users, books with descriptions and
+power-law distributed ratings) in a throwaway SQLite database, then times
+training, hybrid recommendations, similar books and the rate_book endpoint,
+and records peak memory. Results are written as JSON and can be compared
+against a saved baseline:
+
+    python benchmark.py --users 5000 --books 2000 --ratings 200000 --output baseline.json
+    python benchmark.py --users 5000 --books 2000 --ratings 200000 --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+GENRES = {
+    'Fantasy': ['dragon', 'magic', 'wizard', 'quest', 'kingdom', 'sword', 'elf', 'prophecy'],
+    'Science Fiction': ['space', 'robot', 'future', 'alien', 'planet', 'dystopian', 'starship', 'android'],
+    'Romance': ['love', 'passion', 'heart', 'marriage', 'secret', 'longing', 'wedding', 'affair'],
+    'Mystery': ['murder', 'detective', 'clue', 'crime', 'suspect', 'secret', 'investigation', 'alibi'],
+    'Classic': ['society', 'class', 'war', 'family', 'tragedy', 'manners', 'innocence', 'estate'],
+    'Horror': ['ghost', 'haunted', 'blood', 'terror', 'curse', 'monster', 'darkness', 'nightmare'],
+}
+COMMON_WORDS = ['story', 'journey', 'young', 'world', 'life', 'city', 'friend', 'battle',
+                'discover', 'mysterious', 'ancient', 'power', 'lost', 'return', 'hidden', 'truth']
+
+
+def generate_dataset(db, n_users, n_books, n_ratings, seed=42, chunk_size=50000):
+    """
+    Fill an empty database with seeded synthetic data.
+
+    Book popularity and user activity both follow power laws, so a few books
+    and users account for most ratings, as in real catalogs. Ratings are
+    generated and inserted in chunks of users, so memory stays bounded for
+    millions of ratings. Must run inside an application context.
+    """
+    from models import Book, User, Rating
+    rng = np.random.default_rng(seed)
+    genres = list(GENRES)
+
+    for start in range(0, n_users, chunk_size):
+        db.session.execute(db.insert(User), [
+            {'username': f'user{i}'} for i in range(start, min(start + chunk_size, n_users))
+        ])
+
+    n_authors = max(1, n_books // 5)
+    for start in range(0, n_books, chunk_size):
+        rows = []
+        for i in range(start, min(start + chunk_size, n_books)):
+            genre = genres[rng.integers(len(genres))]
+            words = rng.choice(GENRES[genre], size=4).tolist() + rng.choice(COMMON_WORDS, size=6).tolist()
+            rows.append({
+                'title': f'Book {i}',
+                'author': f'Author {rng.integers(n_authors)}',
+                'genre': genre,
+                'description': ' '.join(words),
+                'year': int(rng.integers(1800, 2024)),
+            })
+        db.session.execute(db.insert(Book), rows)
+    db.session.commit()
+
+    # Power-law popularity (books) and activity (users)
+    book_weights = 1.0 / np.arange(1, n_books + 1) ** 0.8
+    book_weights /= book_weights.sum()
+    book_order = rng.permutation(n_books) + 1
+    user_weights = 1.0 / np.arange(1, n_users + 1) ** 0.6
+    user_weights /= user_weights.sum()
+    user_order = rng.permutation(n_users) + 1
+
+    # Draw (user, book) pairs chunk by chunk, dropping duplicates globally
+    seen = np.array([], dtype=np.int64)
+    remaining = n_ratings
+    while remaining > 0:
+        draw = min(chunk_size, int(remaining * 1.2) + 10)
+        users = user_order[rng.choice(n_users, size=draw, p=user_weights)]
+        books = book_order[rng.choice(n_books, size=draw, p=book_weights)]
+        keys = np.unique(users.astype(np.int64) * (n_books + 1) + books)
+        keys = np.setdiff1d(keys, seen, assume_unique=True)[:remaining]
+        if len(keys) == 0:
+            break
+        seen = np.union1d(seen, keys)
+
+        ratings = np.clip(np.round(rng.normal(3.8, 1.0, size=len(keys))), 1, 5).astype(int)
+        db.session.execute(db.insert(Rating), [
+            {'user_id': int(key // (n_books + 1)), 'book_id': int(key % (n_books + 1)), 'rating': int(rating)}
+            for key, rating in zip(keys, ratings)
+        ])
+        db.session.commit()
+        remaining -= len(keys)
+
+    Book.recalculate_average_ratings()
+    db.session.commit()
+    return n_ratings - remaining
+
+
+def percentiles(samples_seconds):
+    """Latency summary in milliseconds"""
+    samples = np.asarray(samples_seconds) * 1000
+    return {
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'p99_ms': float(np.percentile(samples, 99)),
+        'mean_ms': float(samples.mean()),
+    }
+
+
+def peak_memory_mb(func):
+    """Peak Python/NumPy heap allocation while running ``func``, in MB"""
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / (1024 * 1024)
+
+
+def run_benchmarks(args):
+    """Generate data, run every benchmark and return the results dict"""
+    workdir = tempfile.mkdtemp(prefix='recommender-bench-')
+    try:
+        return _run_benchmarks(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _run_benchmarks(args, workdir):
+    """run_benchmarks() with the throwaway database in ``workdir``"""
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['RECOMMENDER_SNAPSHOT_PATH'] = ''
+
+    from app import app, db, recommender_service
+    from recommendation_engine import HybridRecommender
+    model_options = {
+        'collaborative': args.collaborative,
+        'factorization': args.factorization,
+        'content_vectorizer': args.content_vectorizer,
+        'fusion': args.fusion,
+        'n_jobs': args.jobs,
+        'block_size': args.block_size,
+    }
+    recommender_service.model_options.update(model_options)
+
+    rng = np.random.default_rng(args.seed + 1)
+    metrics = {}
+
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        n_ratings = generate_dataset(db, args.users, args.books, args.ratings, seed=args.seed)
+        metrics['generate.seconds'] = time.perf_counter() - start
+
+        # Training
+        train_times = []
+        for _ in range(args.train_repeats):
+            start = time.perf_counter()
+            HybridRecommender(**model_options).train()
+            train_times.append(time.perf_counter() - start)
+        metrics['train.seconds'] = float(np.median(train_times))
+        metrics['train.peak_mb'] = peak_memory_mb(lambda: HybridRecommender(**model_options).train())
+
+        # Publish a model so the endpoints below use it
+        recommender = recommender_service.load_or_train()
+        metrics['model.users'] = len(recommender.user_ids)
+        metrics['model.books'] = len(recommender.catalog)
+        metrics['model.ratings'] = int(recommender.user_book_matrix.nnz)
+
+        user_ids = rng.integers(1, args.users + 1, size=args.requests).tolist()
+        book_ids = rng.integers(1, args.books + 1, size=args.requests).tolist()
+
+        # Hybrid recommendations
+        samples = []
+        for user_id in user_ids:
+            start = time.perf_counter()
+            recommender.get_hybrid_recommendations(user_id, n_recommendations=10)
+            samples.append(time.perf_counter() - start)
+        metrics.update({f'recommend.{k}': v for k, v in percentiles(samples).items()})
+        metrics['recommend.peak_mb'] = peak_memory_mb(
+            lambda: [recommender.get_hybrid_recommendations(u, 10) for u in user_ids[:20]]
+        )
+
+        # Similar books
+        samples = []
+        for book_id in book_ids:
+            start = time.perf_counter()
+            recommender.get_similar_books(book_id, n_recommendations=5)
+            samples.append(time.perf_counter() - start)
+        metrics.update({f'similar.{k}': v for k, v in percentiles(samples).items()})
+
+        # Book edits mirrored into the live model
+        samples = []
+        originals = {}
+        for book_id in book_ids[:50]:
+            originals.setdefault(book_id, recommender.catalog.get(book_id))
+            book = dict(originals[book_id], description=f"Revised edition {book_id}")
+            start = time.perf_counter()
+            recommender.update_catalog(books=[book])
+            samples.append(time.perf_counter() - start)
+        metrics.update({f'catalog_update.{k}': v for k, v in percentiles(samples).items()})
+
+        # The edits never reached the database; put the books back so later
+        # phases do not re-index them when a rating brings in the stored text
+        recommender.update_catalog(books=list(originals.values()))
+
+    # rate_book endpoint through the Flask test client
+    client = app.test_client()
+    samples = []
+    for user_id, book_id in zip(user_ids, book_ids):
+        rating = int(rng.integers(1, 6))
+        start = time.perf_counter()
+        response = client.post(f'/api/users/{user_id}/rate', json={'book_id': book_id, 'rating': rating})
+        samples.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"rate_book failed with {response.status_code}: {response.get_data(as_text=True)}")
+    metrics.update({f'rate.{k}': v for k, v in percentiles(samples).items()})
+
+    return {
+        'config': {
+            'users': args.users,
+            'books': args.books,
+            'ratings': n_ratings,
+            'requests': args.requests,
+            'seed': args.seed,
+            'collaborative': args.collaborative,
+            'factorization': args.factorization,
+            'content_vectorizer': args.content_vectorizer,
+            'fusion': args.fusion,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+        },
+        'metrics': metrics,
+    }
+
+
+# Metrics that describe the dataset rather than performance
+NON_PERFORMANCE_METRICS = {'model.users', 'model.books', 'model.ratings'}
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """
+    Print current vs baseline for every shared metric and return the names
+    of metrics that regressed by more than ``threshold`` (e.g. 0.2 = 20%).
+    """
+    regressions = []
+    print(f"{'metric':<24}{'baseline':>14}{'current':>14}{'change':>10}")
+    for name, current in sorted(results['metrics'].items()):
+        previous = baseline['metrics'].get(name)
+        if previous is None:
+            continue
+        change = (current - previous) / previous if previous else 0.0
+        flag = ''
+        if name not in NON_PERFORMANCE_METRICS and change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<24}{previous:>14.3f}{current:>14.3f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the recommendation engine on synthetic data')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--books', type=int, default=1000)
+    parser.add_argument('--ratings', type=int, default=50000)
+    parser.add_argument('--requests', type=int, default=200, help='Timed calls per endpoint')
+    parser.add_argument('--train-repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--collaborative', choices=['user', 'item', 'mf'], default='user',
+                        help='Collaborative filtering backend to benchmark')
+    parser.add_argument('--factorization', choices=['als', 'svd'], default='als',
+                        help='Factorization used by the mf backend')
+    parser.add_argument('--content-vectorizer', choices=['tfidf', 'hashing'], default='tfidf',
+                        help='Content features; hashing updates the content index on book edits')
+    parser.add_argument('--fusion', choices=['score', 'rank'], default='score',
+                        help='Hybrid fusion: normalized score blend or rank-position merge')
+    parser.add_argument('--jobs', type=int, default=1, help='Training threads')
+    parser.add_argument('--block-size', type=int, default=1024, help='Rows per similarity block')
+    parser.add_argument('--output', help='Write results JSON to this file')
+    parser.add_argument('--baseline', help='Compare against a results JSON saved earlier')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Relative slowdown that counts as a regression (default 0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != results['config']:
+            print("Warning: baseline was recorded with a different configuration", file=sys.stderr)
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Incrementally updatable TF-IDF features for the content model.
+
+Terms are hashed into a fixed feature space, so a book can be vectorized on
+its own without refitting a vocabulary. Raw term counts and document
+frequencies are maintained as books are added or edited. The normalized
+TF-IDF rows are cached: fit() and refresh() weight every row with the
+current IDF, and rows added or replaced later are weighted with that same
+IDF, so all rows stay comparable and an update only touches one row.
+"""
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+DEFAULT_N_FEATURES = 2 ** 18
+
+
+def book_text(book):
+    """Text the content model uses for a serialized book"""
+    # Combine text features, handling None values
+    description = book['description'] if book['description'] else ''
+    return f"{book['genre']} {book['author']} {description}"
+
+
+def _replace_row(matrix, idx, row):
+    """CSR ``matrix`` with row ``idx`` replaced by the single-row CSR ``row``"""
+    start, end = matrix.indptr[idx], matrix.indptr[idx + 1]
+    indptr = matrix.indptr.copy()
+    indptr[idx + 1:] += row.nnz - (end - start)
+    return sparse.csr_matrix((
+        np.concatenate([matrix.data[:start], row.data, matrix.data[end:]]),
+        np.concatenate([matrix.indices[:start], row.indices, matrix.indices[end:]]),
+        indptr
+    ), shape=matrix.shape)
+
+
+def _append_row(matrix, row):
+    """CSR ``matrix`` with the single-row CSR ``row`` appended"""
+    return sparse.csr_matrix((
+        np.concatenate([matrix.data, row.data]),
+        np.concatenate([matrix.indices, row.indices]),
+        np.append(matrix.indptr, matrix.indptr[-1] + row.nnz)
+    ), shape=(matrix.shape[0] + 1, matrix.shape[1]))
+
+
+class IncrementalTfidf:
+    """
+    Hashed term counts of every book, document frequencies and cached weights.
+
+    Row ``i`` holds book ``i`` of the catalog. Weights use the same smoothed
+    IDF and L2 normalization as sklearn's TfidfVectorizer.
+    """
+
+    def __init__(self, n_features=DEFAULT_N_FEATURES):
+        self.n_features = n_features
+        self.hasher = HashingVectorizer(
+            n_features=n_features, stop_words='english', alternate_sign=False, norm=None
+        )
+        self.counts = sparse.csr_matrix((0, n_features), dtype=np.float64)
+        self.document_frequencies = np.zeros(n_features, dtype=np.int64)
+        self.n_documents = 0
+        self.idf_ = self.idf()
+        self._weights = self.counts.copy()
+
+    def __len__(self):
+        return self.counts.shape[0]
+
+    def _count(self, texts):
+        counts = self.hasher.transform(texts).tocsr()
+        counts.sum_duplicates()
+        return counts
+
+    def _add_frequencies(self, counts, sign):
+        np.add.at(self.document_frequencies, counts.indices, sign)
+        self.n_documents += sign * int(np.count_nonzero(np.diff(counts.indptr)))
+
+    def _weigh(self, counts):
+        weights = counts.copy()
+        weights.data = weights.data * self.idf_[weights.indices]
+        return normalize(weights)
+
+    def fit(self, texts):
+        """Replace all rows with the counts of ``texts``"""
+        self.counts = self._count(texts)
+        self.document_frequencies[:] = 0
+        self.n_documents = 0
+        self._add_frequencies(self.counts, 1)
+        return self.refresh()
+
+    def refresh(self):
+        """Re-weight every row with the current document frequencies"""
+        self.idf_ = self.idf()
+        return self.reweigh()
+
+    def reweigh(self):
+        """Re-weight every row with the stored IDF (``idf_``), e.g. after loading"""
+        self._weights = self._weigh(self.counts)
+        return self
+
+    def append(self, text):
+        """Add a row for a new book and return its index"""
+        counts = self._count([text])
+        self.counts = _append_row(self.counts, counts)
+        self._weights = _append_row(self._weights, self._weigh(counts))
+        self._add_frequencies(counts, 1)
+        return len(self) - 1
+
+    def replace(self, idx, text):
+        """Re-vectorize the book at row ``idx`` (empty text clears it)"""
+        old = self.counts[idx]
+        new = self._count([text])
+        self._add_frequencies(old, -1)
+        self._add_frequencies(new, 1)
+        self.counts = _replace_row(self.counts, idx, new)
+        self._weights = _replace_row(self._weights, idx, self._weigh(new))
+
+    def idf(self):
+        return np.log((1 + self.n_documents) / (1 + self.document_frequencies)) + 1
+
+    def weights(self):
+        """L2-normalized TF-IDF matrix of every row, weighted with ``idf_``"""
+        return self._weights
@@ -0,0 +1,99 @@
+"""
+Keyset-paginated, field-projected listings of API resources.
+
+Listings select only the requested columns in primary key order and page
+with ``WHERE id > :after`` instead of OFFSET, so every page costs the same
+however deep into the table it is. Rows are read as plain tuples in chunks,
+which keeps streamed exports at constant memory. All functions must run
+inside an application context.
+"""
+import json
+
+from models import db
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 1000
+
+
+class ListingError(ValueError):
+    """Raised for invalid listing parameters (fields, after, limit)"""
+
+
+def parse_fields(model, fields=None):
+    """
+    (API field, attribute) pairs to return for a comma-separated ``fields``
+    parameter, in the model's serialization order. The id is always
+    included since it is the pagination key.
+    """
+    available = dict(model.SERIALIZED_FIELDS)
+    if not fields:
+        return list(model.SERIALIZED_FIELDS)
+    requested = {field.strip() for field in fields.split(',') if field.strip()}
+    unknown = requested - set(available)
+    if unknown:
+        raise ListingError(f"unknown fields: {', '.join(sorted(unknown))}")
+    requested.add('id')
+    return [(field, attr) for field, attr in model.SERIALIZED_FIELDS if field in requested]
+
+
+def parse_page_args(args, default_limit=DEFAULT_PAGE_SIZE):
+    """Validated ``(after, limit)`` from request arguments; ``limit`` is capped"""
+    try:
+        after = int(args['after']) if args.get('after') else None
+        limit = int(args.get('limit', default_limit))
+    except ValueError:
+        raise ListingError("after and limit must be valid integers")
+    if limit < 1:
+        raise ListingError("limit must be at least 1")
+    return after, min(limit, MAX_PAGE_SIZE)
+
+
+def _select(model, fields, after=None):
+    stmt = db.select(*(getattr(model, attr) for _, attr in fields)).order_by(model.id)
+    if after is not None:
+        stmt = stmt.where(model.id > after)
+    return stmt
+
+
+def fetch_page(model, fields, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    One page of rows as dicts, and the ``after`` value of the next page
+    (None on the last page).
+    """
+    names = [field for field, _ in fields]
+    rows = db.session.execute(_select(model, fields, after).limit(limit + 1)).all()
+    items = [dict(zip(names, row)) for row in rows[:limit]]
+    next_after = items[-1]['id'] if len(rows) > limit else None
+    return items, next_after
+
+
+def iter_rows(model, fields, after=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield every row after ``after`` as a dict, fetching ``chunk_size`` rows at a time"""
+    names = [field for field, _ in fields]
+    result = db.session.execute(_select(model, fields, after).execution_options(yield_per=chunk_size))
+    for rows in result.partitions():
+        for row in rows:
+            yield dict(zip(names, row))
+
+
+def iter_ndjson(rows):
+    """Encode rows as newline-delimited JSON"""
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def iter_json_array(rows, chunk_size=STREAM_CHUNK_SIZE):
+    """Encode rows as one JSON array, emitted in chunks of ``chunk_size`` rows"""
+    yield '['
+    chunk = []
+    first = True
+    for row in rows:
+        chunk.append(json.dumps(row))
+        if len(chunk) >= chunk_size:
+            yield ('' if first else ',') + ','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ('' if first else ',') + ','.join(chunk)
+    yield ']'
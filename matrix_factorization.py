@@ -0,0 +1,124 @@
+"""
+Latent-factor models of the sparse user-book rating matrix.
+
+Both methods return ``(user_factors, item_factors)`` dense arrays of shape
+(users, f) and (books, f); a user's predicted scores for every book are
+``user_factors[u] @ item_factors.T``.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import svds
+
+# Rows per ALS solve block; bounds the (rows x f x f) normal equations
+ALS_BLOCK_ROWS = 1024
+
+
+def _triu_layout(n_factors):
+    """
+    Row/column indices of the upper triangle of an f x f matrix, and for each
+    of its f * f entries the position of that entry in the triangle
+    """
+    rows, cols = np.triu_indices(n_factors)
+    positions = np.empty((n_factors, n_factors), dtype=np.intp)
+    positions[rows, cols] = np.arange(len(rows))
+    positions[cols, rows] = np.arange(len(rows))
+    return rows, cols, positions.ravel()
+
+
+def _solve_block(matrix, fixed, outer, positions, regularization, start, end, out):
+    """
+    Ridge-regress rows ``start:end`` of ``matrix`` on the fixed factors of the
+    entities they rated, writing the solutions into ``out``. Regularization
+    is scaled by each row's number of ratings (ALS-WR).
+
+    The normal equations of every row come from two sparse products: the
+    0/1 rating pattern times the (upper triangles of the) outer products of
+    the fixed factors, and the ratings times the fixed factors.
+    """
+    n_factors = fixed.shape[1]
+    block = matrix[start:end]
+    rated = block.copy()
+    rated.data = np.ones_like(rated.data)
+    counts = np.diff(block.indptr)
+
+    gram = np.take(rated @ outer, positions, axis=1)
+    gram[:, ::n_factors + 1] += regularization * np.maximum(counts, 1)[:, None]
+    gram = gram.reshape(-1, n_factors, n_factors)
+    rhs = block @ fixed
+    out[start:end] = np.linalg.solve(gram, rhs[:, :, None])[:, :, 0]
+
+
+def _solve_factors(matrix, fixed, regularization, n_jobs):
+    """One ALS half-step: solve the factors of every row of ``matrix``"""
+    out = np.empty((matrix.shape[0], fixed.shape[1]))
+    rows, cols, positions = _triu_layout(fixed.shape[1])
+    outer = fixed[:, rows] * fixed[:, cols]
+    blocks = [(start, min(start + ALS_BLOCK_ROWS, matrix.shape[0]))
+              for start in range(0, matrix.shape[0], ALS_BLOCK_ROWS)]
+    if n_jobs > 1:
+        # NumPy releases the GIL inside the batched solves
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(
+                lambda block: _solve_block(matrix, fixed, outer, positions, regularization, *block, out), blocks
+            ))
+    else:
+        for start, end in blocks:
+            _solve_block(matrix, fixed, outer, positions, regularization, start, end, out)
+    return out
+
+
+def als_factorize(matrix, n_factors=32, regularization=0.1, iterations=10, n_jobs=1, seed=0):
+    """
+    Alternating least squares over the observed ratings only.
+
+    Args:
+        matrix: Sparse (users x books) rating matrix, 0 = not rated
+        n_factors: Latent dimensions
+        regularization: L2 penalty, scaled by each user's/book's rating count
+        iterations: Alternating user/book passes
+        n_jobs: Threads solving blocks of users/books in parallel
+        seed: Seed for the initial book factors
+    """
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+    transposed = matrix.T.tocsr()
+    rng = np.random.default_rng(seed)
+    item_factors = rng.normal(scale=0.1, size=(matrix.shape[1], n_factors))
+    user_factors = np.zeros((matrix.shape[0], n_factors))
+    for _ in range(iterations):
+        user_factors = _solve_factors(matrix, item_factors, regularization, n_jobs)
+        item_factors = _solve_factors(transposed, user_factors, regularization, n_jobs)
+    return user_factors, item_factors
+
+
+def svd_factorize(matrix, n_factors=32, seed=0):
+    """
+    Truncated SVD of the rating matrix (unrated entries count as 0).
+    User factors carry the singular values, so item factors are orthonormal.
+    """
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+    k = min(n_factors, min(matrix.shape) - 1)
+    if k < 1:
+        u, s, vt = np.linalg.svd(matrix.toarray(), full_matrices=False)
+        k = min(n_factors, len(s))
+        u, s, vt = u[:, :k], s[:k], vt[:k]
+    else:
+        u, s, vt = svds(matrix, k=k, random_state=seed)
+    return u * s, vt.T.copy()
+
+
+def fold_in_user(book_indices, ratings, item_factors, method='als', regularization=0.1):
+    """
+    Factors for one user from their ratings, keeping the book factors fixed,
+    so new users and new ratings are served without retraining.
+    """
+    if len(book_indices) == 0:
+        return np.zeros(item_factors.shape[1])
+    factors = item_factors[book_indices]
+    ratings = np.asarray(ratings, dtype=np.float64)
+    if method == 'svd':
+        # Item factors are orthonormal, so projecting reproduces U * S
+        return ratings @ factors
+    gram = factors.T @ factors + regularization * len(ratings) * np.eye(item_factors.shape[1])
+    return np.linalg.solve(gram, factors.T @ ratings)
@@ -0,0 +1,219 @@
+"""
+Lightweight in-process metrics with Prometheus text exposition.
+
+Metrics are module-level objects updated from the hot paths of the
+recommender and the Flask routes. When the registry is disabled every update
+returns immediately, so instrumentation costs next to nothing.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _NoopTimer:
+    """Context manager returned by Histogram.time() while metrics are disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+class _Timer:
+    """Observe the elapsed time of a ``with`` block into a histogram"""
+
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, registry, name, help_text):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        """Yield (suffix, labels, value) for the exposition format"""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield '', key, value
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield '', key, value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+    type_name = 'histogram'
+
+    def __init__(self, registry, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+        for hook in self.registry.hooks:
+            hook(self.name, labels, value)
+
+    def time(self, **labels):
+        """Context manager timing its block into this histogram"""
+        if not self.registry.enabled:
+            return _NOOP_TIMER
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield '_bucket', key + (('le', le),), cumulative
+            yield '_sum', key, total
+            yield '_count', key, count
+
+
+class MetricsRegistry:
+    """
+    Holds all metrics and renders them in the Prometheus text format.
+
+    ``hooks`` are called as ``hook(name, labels, seconds)`` for every histogram
+    observation, e.g. to feed a profiler or log slow stages.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.hooks = []
+        self._metrics = []
+
+    def counter(self, name, help_text):
+        return self._register(Counter(self, name, help_text))
+
+    def gauge(self, name, help_text):
+        return self._register(Gauge(self, name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, help_text, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_hook(self, hook):
+        """Register a profiling hook called for every timed observation"""
+        self.hooks.append(hook)
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            for suffix, labels, value in metric.samples():
+                label_text = ','.join(f'{name}="{_escape(value)}"' for name, value in labels)
+                label_text = f'{{{label_text}}}' if label_text else ''
+                lines.append(f'{metric.name}{suffix}{label_text} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    'recommender_stage_seconds',
+    'Time spent in recommender training and scoring stages'
+)
+TRAIN_SECONDS = registry.histogram(
+    'recommender_train_seconds',
+    'Duration of full recommender training runs'
+)
+MODEL_SIZE = registry.gauge(
+    'recommender_model_size',
+    'Number of users, books and ratings in the last trained model'
+)
+MODEL_BYTES = registry.gauge(
+    'recommender_model_bytes',
+    'Memory used by the arrays of the last trained model'
+)
+CACHE_REQUESTS = registry.counter(
+    'recommender_cache_requests_total',
+    'Cache lookups by cache and result (hit or miss)'
+)
+HTTP_REQUEST_SECONDS = registry.histogram(
+    'http_request_duration_seconds',
+    'HTTP request latency by endpoint'
+)
@@ -0,0 +1,411 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process training lock
+    fcntl = None
+
+from sqlalchemy import event
+
+from models import db, Book
+from recommendation_engine import HybridRecommender
+from training_data import count_ratings, load_rating_arrays
+
+
+# Model options that do not change the trained arrays (how training runs,
+# and how scores are fused when serving), so a snapshot trained with other
+# values can still be used and gets the configured ones applied on load
+RUNTIME_OPTIONS = ('n_jobs', 'block_size', 'fusion')
+
+
+class RecommenderService:
+    """
+    Owns the live HybridRecommender and retrains it in the background.
+
+    A single worker thread rebuilds a fresh model when the retrain interval
+    elapses or after enough new ratings, then publishes it with an atomic
+    reference swap. Serving threads only ever read the current reference, so
+    they never block on training or see a half-built model. Concurrent
+    retrain requests are coalesced into one training run.
+
+    ``model_options`` are passed to every HybridRecommender it trains.
+
+    When ``snapshot_path`` is set, every trained model is saved there and
+    the memory-mapped snapshot is what gets published, so worker processes
+    share one copy of the model data. start() maps an existing snapshot
+    instead of training, so workers start instantly. Only one process trains
+    at a time (an exclusive lock on ``<snapshot_path>.lock``); the others
+    check every ``snapshot_poll_interval`` seconds for a newer snapshot and
+    map it. Ratings created after a snapshot was trained are applied on load.
+
+    Committed changes to books are mirrored into the live model's catalog
+    cache, so request handlers can serve book details without queries.
+
+    ``model_version`` increases with every published model and
+    rating_version() with every rating a user adds, so callers can key
+    cached results on them; swap listeners run after each publish.
+    """
+
+    def __init__(self, app, retrain_interval=3600, retrain_after_ratings=100, snapshot_path=None,
+                 model_options=None, snapshot_poll_interval=30):
+        self.app = app
+        self.model_options = dict(model_options or {})
+        self.snapshot_path = snapshot_path
+        self.snapshot_poll_interval = snapshot_poll_interval
+        self.retrain_interval = retrain_interval
+        self.retrain_after_ratings = retrain_after_ratings
+        self.last_trained_at = None
+        self._snapshot_checked_at = None
+        self.model_version = 0
+        self._model = None
+        self._lock = threading.Lock()
+        self._retrain_requested = threading.Event()
+        self._stop_requested = threading.Event()
+        self._thread = None
+        self._training = False
+        self._pending_updates = []
+        self._ratings_since_train = 0
+        self._rating_versions = {}
+        self._swap_listeners = []
+        self._register_catalog_listeners()
+
+    def get_model(self):
+        """
+        Return the current model, or None while the first model is training.
+
+        Starts the background worker on first use so the model is warmed
+        lazily when the app runs without an explicit start() call.
+        """
+        model = self._model
+        if model is None:
+            self.start(warm=False)
+        return model
+
+    def start(self, warm=True):
+        """
+        Start the background worker thread (idempotent).
+
+        Args:
+            warm: Train the first model synchronously before returning
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='recommender-retrain', daemon=True)
+
+        if self._model is None:
+            self._load_snapshot()
+        if warm and self._model is None:
+            self.retrain()
+        elif self._model is None:
+            self._retrain_requested.set()
+        self._thread.start()
+
+    def load_or_train(self):
+        """
+        Return the current model, loading the snapshot or training
+        synchronously if there is none, without starting the worker thread.
+        Intended for offline jobs and CLI commands.
+        """
+        if self._model is None:
+            self._load_snapshot()
+        if self._model is None:
+            self.retrain()
+        return self._model
+
+    def stop(self, timeout=None):
+        """Stop the background worker thread"""
+        self._stop_requested.set()
+        self._retrain_requested.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def add_swap_listener(self, callback):
+        """Call ``callback(model)`` after every newly published model"""
+        self._swap_listeners.append(callback)
+
+    def rating_version(self, user_id):
+        """Counter bumped after each rating by ``user_id`` reaches the live model"""
+        return self._rating_versions.get(user_id, 0)
+
+    def request_retrain(self):
+        """Ask the worker to retrain; repeated requests collapse into one run"""
+        self._retrain_requested.set()
+
+    def record_rating(self, user_id, book_id, rating):
+        """
+        Apply a new rating to the live model and count it towards a retrain.
+
+        Updates that arrive while a new model is training are replayed onto
+        that model before it is published, so they are never lost in the swap.
+        """
+        with self._lock:
+            model = self._model
+            if self._training:
+                self._pending_updates.append(('apply_rating', (user_id, book_id, rating)))
+            self._ratings_since_train += 1
+            should_retrain = self._ratings_since_train >= self.retrain_after_ratings
+
+        if model is not None:
+            model.apply_rating(user_id, book_id, rating)
+        with self._lock:
+            self._rating_versions[user_id] = self._rating_versions.get(user_id, 0) + 1
+        if should_retrain:
+            self.request_retrain()
+
+    def update_catalog(self, books=(), removed_ids=()):
+        """Mirror changed (serialized) and deleted books into the live catalog"""
+        with self._lock:
+            model = self._model
+            if self._training:
+                self._pending_updates.append(('update_catalog', (list(books), list(removed_ids))))
+
+        if model is not None:
+            model.update_catalog(books, removed_ids)
+
+    def _register_catalog_listeners(self):
+        """Collect book changes per session and apply them once committed"""
+        def after_flush(session, flush_context):
+            changes = session.info.setdefault('catalog_changes', {})
+            for obj in list(session.new) + list(session.dirty):
+                if isinstance(obj, Book):
+                    changes[obj.id] = obj.to_dict()
+            for obj in session.deleted:
+                if isinstance(obj, Book):
+                    changes[obj.id] = None
+
+        def after_commit(session):
+            changes = session.info.pop('catalog_changes', None)
+            if changes:
+                self.update_catalog(
+                    books=[book for book in changes.values() if book is not None],
+                    removed_ids=[book_id for book_id, book in changes.items() if book is None]
+                )
+
+        def after_rollback(session):
+            session.info.pop('catalog_changes', None)
+
+        event.listen(db.session, 'after_flush', after_flush)
+        event.listen(db.session, 'after_commit', after_commit)
+        event.listen(db.session, 'after_rollback', after_rollback)
+
+    def _run(self):
+        """
+        Worker loop: wait for a trigger or the interval, then retrain. With
+        a snapshot, also wake up every poll interval to map a snapshot saved
+        by another process.
+        """
+        timeout = self.retrain_interval
+        if self.snapshot_path:
+            timeout = min(timeout, self.snapshot_poll_interval)
+        while not self._stop_requested.is_set():
+            triggered = self._retrain_requested.wait(timeout)
+            if self._stop_requested.is_set():
+                break
+            try:
+                if triggered or self._model_age() >= self.retrain_interval:
+                    self._retrain_requested.clear()
+                    self.retrain()
+                else:
+                    self._reload_snapshot()
+            except Exception as e:
+                # Keep serving the previous model if training fails
+                print(f"Background retraining failed: {e}")
+
+    def _model_age(self):
+        """Seconds since the live model was trained (infinite before the first one)"""
+        if self.last_trained_at is None:
+            return float('inf')
+        return time.time() - self.last_trained_at
+
+    def _snapshot_trained_at(self):
+        """Training time recorded in the snapshot on disk, or None"""
+        if not self.snapshot_path:
+            return None
+        try:
+            with open(os.path.join(self.snapshot_path, 'metadata.json')) as f:
+                return json.load(f).get('trained_at')
+        except (OSError, ValueError):
+            return None
+
+    def _snapshot_is_newer(self):
+        """Whether the snapshot on disk was trained after the live model (and not yet rejected)"""
+        trained_at = self._snapshot_trained_at()
+        if trained_at is None:
+            return False
+        seen = [t for t in (self.last_trained_at, self._snapshot_checked_at) if t is not None]
+        return not seen or trained_at > max(seen)
+
+    @contextmanager
+    def _training_lock(self, wait=False):
+        """
+        Hold the exclusive cross-process training lock next to the snapshot
+        for the duration of the block. Unless ``wait`` is set, yields False
+        without waiting when another process holds it.
+        """
+        if not self.snapshot_path or fcntl is None:
+            yield True
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.snapshot_path)), exist_ok=True)
+        with open(f"{self.snapshot_path}.lock", 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _map_snapshot(self):
+        """Memory-map the snapshot on disk, or None if there is no usable one"""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return None
+        try:
+            model = HybridRecommender.load(self.snapshot_path, mmap=True)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not load recommender snapshot: {e}")
+            return None
+        self._snapshot_checked_at = model.trained_at
+        changed = [
+            name for name, value in self.model_options.items()
+            if name not in RUNTIME_OPTIONS and getattr(model, name) != value
+        ]
+        if changed:
+            print(f"Ignoring recommender snapshot trained with different {', '.join(changed)}")
+            return None
+        for name in RUNTIME_OPTIONS:
+            if name in self.model_options:
+                setattr(model, name, self.model_options[name])
+        return model
+
+    def _load_snapshot(self):
+        """Publish the model from the snapshot on disk, if there is a usable one, and return it"""
+        def build():
+            model = self._map_snapshot()
+            if model is not None:
+                self._catch_up(model)
+            return model
+
+        model = self._swap(build)
+        if model is None:
+            return None
+        print(f"Loaded recommender snapshot from {self.snapshot_path}")
+
+        # Refresh in the background if the snapshot is already stale
+        if model.trained_at is None or time.time() - model.trained_at > self.retrain_interval:
+            self._retrain_requested.set()
+        return model
+
+    def _reload_snapshot(self):
+        """Publish the snapshot on disk if another process saved a newer one"""
+        if self._snapshot_is_newer():
+            self._load_snapshot()
+
+    def _catch_up(self, model):
+        """
+        Apply ratings created or changed since ``model`` was trained. Large
+        backlogs are left to a full retrain instead of being applied one by
+        one; they are counted first so they are never loaded here.
+        """
+        if model.trained_at is None:
+            return
+        since = datetime.utcfromtimestamp(model.trained_at)
+        with self.app.app_context():
+            if count_ratings(since=since) > self.retrain_after_ratings:
+                self._retrain_requested.set()
+                return
+            user_col, book_col, rating_col = load_rating_arrays(since=since)
+
+        for user_id, book_id, rating in zip(user_col.tolist(), book_col.tolist(), rating_col.tolist()):
+            model.apply_rating(user_id, book_id, rating)
+        self._ratings_since_train += len(user_col)
+
+    def _swap(self, build):
+        """
+        Publish the model returned by ``build()`` (unless it is None),
+        replaying the updates that arrived while it was being built.
+
+        Replaying the updates and swapping the reference happen under one
+        lock, so an update lands either in the pending list or on the new
+        model, never only on the outgoing one. Swap listeners run after the
+        lock is released.
+        """
+        with self._lock:
+            self._training = True
+            self._pending_updates = []
+
+        try:
+            model = build()
+        except Exception:
+            with self._lock:
+                self._training = False
+            raise
+
+        with self._lock:
+            if model is not None:
+                for method, args in self._pending_updates:
+                    getattr(model, method)(*args)
+                self._model = model
+                self.last_trained_at = model.trained_at
+                self.model_version += 1
+            self._pending_updates = []
+            self._training = False
+        if model is not None:
+            for callback in self._swap_listeners:
+                callback(model)
+        return model
+
+    def retrain(self, wait=False):
+        """
+        Train a fresh model synchronously and atomically publish it.
+
+        With a snapshot, the model is saved and its memory-mapped snapshot
+        published instead. If another process is training, nothing is done
+        here (its snapshot is picked up when saved); if one finished training
+        since the live model was published, its snapshot is mapped instead.
+
+        Args:
+            wait: Wait for another process's training to finish and then
+                train anyway, e.g. because the data changed after it started
+        """
+        with self._training_lock(wait) as acquired:
+            if not acquired:
+                print("Another process is training the recommender; waiting for its snapshot")
+                return
+            if not wait and self._snapshot_is_newer() and self._load_snapshot() is not None:
+                return
+
+            def build():
+                with self._lock:
+                    self._ratings_since_train = 0
+                model = HybridRecommender(**self.model_options)
+                with self.app.app_context():
+                    model.train()
+                model = self._save_snapshot(model)
+
+                # Ratings other processes committed while this one was training
+                self._catch_up(model)
+                return model
+
+            self._swap(build)
+
+    def _save_snapshot(self, model):
+        """
+        Save ``model`` as the snapshot and return the memory-mapped copy, so
+        every process serves the same pages; ``model`` itself without one.
+        """
+        if not self.snapshot_path:
+            return model
+        try:
+            model.save(self.snapshot_path)
+        except OSError as e:
+            print(f"Could not save recommender snapshot: {e}")
+            return model
+        return self._map_snapshot() or model
@@ -12,17 +12,73 @@ class Book(db.Model):
     description = db.Column(db.Text)
     year = db.Column(db.Integer)
     average_rating = db.Column(db.Float, default=0.0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
     ratings = db.relationship('Rating', backref='book', lazy=True, cascade='all, delete-orphan')
     
-    def update_average_rating(self):
-        """Update the average rating for this book"""
-        if self.ratings:
-            total = sum(r.rating for r in self.ratings)
-            self.average_rating = total / len(self.ratings)
-        else:
-            self.average_rating = 0.0
-        db.session.commit()
+    def apply_rating_change(self, old_rating, new_rating):
+        """
+        Adjust the running rating sum/count for one added, changed or removed
+        rating (pass None for the missing side) without reading other ratings.
+        
+        The new values are computed in the UPDATE statement itself, so
+        concurrent writes cannot lose increments. Does not commit; the change is
+        flushed in the same transaction as the rating row.
+        """
+        delta_sum = (new_rating or 0) - (old_rating or 0)
+        delta_count = (new_rating is not None) - (old_rating is not None)
+        new_sum = Book.rating_sum + delta_sum
+        new_count = Book.rating_count + delta_count
+        self.rating_sum = new_sum
+        self.rating_count = new_count
+        self.average_rating = db.case(
+            (new_count > 0, db.cast(new_sum, db.Float) / new_count),
+            else_=0.0
+        )
+    
+    @classmethod
+    def recalculate_average_ratings(cls, book_ids=None):
+        """
+        Recalculate rating aggregates for many books (all books by default)
+        with one aggregate UPDATE. Does not commit, and does not refresh Book
+        instances already loaded in the session.
+        """
+        rating_sum = db.select(db.func.coalesce(db.func.sum(Rating.rating), 0)).where(
+            Rating.book_id == cls.id
+        ).scalar_subquery()
+        rating_count = db.select(db.func.count(Rating.id)).where(
+            Rating.book_id == cls.id
+        ).scalar_subquery()
+        
+        stmt = db.update(cls).values(rating_sum=rating_sum, rating_count=rating_count)
+        if book_ids is not None:
+            stmt = stmt.where(cls.id.in_(list(book_ids)))
+        db.session.execute(stmt, execution_options={'synchronize_session': False})
+        
+        stmt = db.update(cls).values(average_rating=db.case(
+            (cls.rating_count > 0, db.cast(cls.rating_sum, db.Float) / cls.rating_count),
+            else_=0.0
+        ))
+        if book_ids is not None:
+            stmt = stmt.where(cls.id.in_(list(book_ids)))
+        db.session.execute(stmt, execution_options={'synchronize_session': False})
+    
+    # (API field, attribute) pairs serialized by to_dict(), also used to read
+    # the same fields as plain columns without loading Book objects
+    SERIALIZED_FIELDS = (
+        ('id', 'id'),
+        ('title', 'title'),
+        ('author', 'author'),
+        ('genre', 'genre'),
+        ('description', 'description'),
+        ('year', 'year'),
+        ('rating', 'average_rating')
+    )
+    
+    def to_dict(self):
+        """Serialize the book for API responses"""
+        return {field: getattr(self, attr) for field, attr in self.SERIALIZED_FIELDS}
     
     def __repr__(self):
         return f'<Book {self.title}>'
@@ -35,6 +91,16 @@ class User(db.Model):
     
     ratings = db.relationship('Rating', backref='user', lazy=True, cascade='all, delete-orphan')
     
+    # (API field, attribute) pairs serialized by to_dict()
+    SERIALIZED_FIELDS = (
+        ('id', 'id'),
+        ('username', 'username')
+    )
+    
+    def to_dict(self):
+        """Serialize the user for API responses"""
+        return {field: getattr(self, attr) for field, attr in self.SERIALIZED_FIELDS}
+    
     def __repr__(self):
         return f'<User {self.username}>'
 
@@ -42,11 +108,24 @@ class Rating(db.Model):
     """Rating model"""
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False, index=True)
     rating = db.Column(db.Integer, nullable=False)  # 1-5 scale
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Also set when the rating is changed, so model catch-ups see changed ratings
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     __table_args__ = (db.UniqueConstraint('user_id', 'book_id', name='_user_book_uc'),)
     
     def __repr__(self):
         return f'<Rating user={self.user_id} book={self.book_id} rating={self.rating}>'
+
+class UserRecommendation(db.Model):
+    """Precomputed top-N recommendations for a user (one row per user)"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    book_ids = db.Column(db.JSON, nullable=False)  # Best first
+    n_recommendations = db.Column(db.Integer, nullable=False)
+    alpha = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<UserRecommendation user={self.user_id} books={len(self.book_ids)}>'
@@ -0,0 +1,66 @@
+from models import db, User, UserRecommendation
+
+
+def precompute_recommendations(recommender, user_ids=None, n_recommendations=20, alpha=0.5, batch_size=1000):
+    """
+    Compute top-N hybrid recommendations for many users and store them in the
+    UserRecommendation table, replacing any previous lists.
+
+    Users are processed in batches, each scored with
+    HybridRecommender.get_batch_recommendations() and written in one
+    transaction. Must run inside an application context.
+
+    Args:
+        recommender: Trained HybridRecommender
+        user_ids: Users to precompute (all users by default)
+        n_recommendations: Length of each stored list
+        alpha: Weight for collaborative filtering (1-alpha for content-based)
+        batch_size: Users per batch and transaction
+
+    Returns:
+        Number of users written
+    """
+    if user_ids is None:
+        user_ids = db.session.scalars(db.select(User.id).order_by(User.id)).all()
+    user_ids = list(user_ids)
+
+    written = 0
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        recommendations = recommender.get_batch_recommendations(
+            batch, n_recommendations=n_recommendations, alpha=alpha
+        )
+
+        db.session.execute(db.delete(UserRecommendation).where(UserRecommendation.user_id.in_(batch)))
+        db.session.execute(db.insert(UserRecommendation), [
+            {
+                'user_id': user_id,
+                'book_ids': book_ids,
+                'n_recommendations': n_recommendations,
+                'alpha': alpha
+            }
+            for user_id, book_ids in recommendations.items()
+        ])
+        db.session.commit()
+        written += len(batch)
+
+    return written
+
+
+def get_precomputed_recommendations(user_id, n_recommendations=10, alpha=0.5):
+    """
+    Return a stored list of recommended book IDs for a user with a single
+    primary-key read, or None if there is no usable list.
+    """
+    stored = db.session.get(UserRecommendation, user_id)
+    if stored is None or stored.alpha != alpha or stored.n_recommendations < n_recommendations:
+        return None
+    return stored.book_ids[:n_recommendations]
+
+
+def invalidate_precomputed_recommendations(user_ids):
+    """Delete stored lists for users whose ratings changed (does not commit)"""
+    db.session.execute(
+        db.delete(UserRecommendation).where(UserRecommendation.user_id.in_(list(user_ids))),
+        execution_options={'synchronize_session': False}
+    )
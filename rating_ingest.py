@@ -0,0 +1,187 @@
+import csv
+import io
+import json
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Book, User, Rating
+from precompute import invalidate_precomputed_recommendations
+
+# Keep at most this many error messages in the ingestion summary
+MAX_REPORTED_ERRORS = 100
+
+
+class RatingEventError(ValueError):
+    """Raised for a rating event that cannot be parsed or validated"""
+
+
+def parse_rating_event(event):
+    """Validate one rating event (a mapping) and return (user_id, book_id, rating)"""
+    try:
+        user_id = int(event['user_id'])
+        book_id = int(event['book_id'])
+        rating = int(event['rating'])
+    except KeyError as e:
+        raise RatingEventError(f"missing field {e.args[0]!r}")
+    except (ValueError, TypeError):
+        raise RatingEventError("user_id, book_id and rating must be integers")
+
+    if rating < 1 or rating > 5:
+        raise RatingEventError("rating must be between 1 and 5")
+    return user_id, book_id, rating
+
+
+def iter_rating_events(stream, fmt='jsonl'):
+    """
+    Stream rating events from a text file object, one line at a time.
+
+    Yields ``(line_number, event)`` where ``event`` is either a parsed
+    ``(user_id, book_id, rating)`` tuple or a RatingEventError for a bad line,
+    so a single malformed line does not abort the whole import.
+
+    Args:
+        stream: Text stream of JSON Lines, or CSV with a
+            ``user_id,book_id,rating`` header
+        fmt: 'jsonl' or 'csv'
+    """
+    if fmt == 'jsonl':
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                event = json.loads(line)
+                if not isinstance(event, dict):
+                    raise RatingEventError("each line must be a JSON object")
+                yield line_number, parse_rating_event(event)
+            except json.JSONDecodeError:
+                yield line_number, RatingEventError("invalid JSON")
+            except RatingEventError as e:
+                yield line_number, e
+    elif fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            try:
+                yield reader.line_num, parse_rating_event(row)
+            except RatingEventError as e:
+                yield reader.line_num, e
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+
+
+def open_text_stream(binary_stream):
+    """Wrap a binary stream (e.g. a request body) for line-by-line text reading"""
+    return io.TextIOWrapper(binary_stream, encoding='utf-8', newline='')
+
+
+def _upsert_ratings(rows):
+    """
+    Insert or update ``rows`` (dicts of user_id, book_id, rating), unique per
+    (user_id, book_id). One INSERT ... ON CONFLICT DO UPDATE on SQLite and
+    PostgreSQL; on other databases, one query for the existing pairs then
+    one bulk UPDATE and one bulk INSERT.
+    """
+    dialect = db.engine.dialect.name
+    insert = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}.get(dialect)
+    now = datetime.utcnow()
+    if insert is not None:
+        stmt = insert(Rating).values(rows)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['user_id', 'book_id'],
+            set_={'rating': stmt.excluded.rating, 'updated_at': now}
+        ))
+        return
+
+    existing = {
+        (user_id, book_id): rating_id
+        for rating_id, user_id, book_id in db.session.execute(
+            db.select(Rating.id, Rating.user_id, Rating.book_id).where(
+                Rating.user_id.in_({row['user_id'] for row in rows}),
+                Rating.book_id.in_({row['book_id'] for row in rows})
+            )
+        )
+    }
+    updates = [
+        {'id': existing[(row['user_id'], row['book_id'])], 'rating': row['rating'], 'updated_at': now}
+        for row in rows if (row['user_id'], row['book_id']) in existing
+    ]
+    inserts = [row for row in rows if (row['user_id'], row['book_id']) not in existing]
+    if updates:
+        db.session.execute(db.update(Rating), updates)
+    if inserts:
+        db.session.execute(db.insert(Rating), inserts)
+
+
+def _ingest_batch(batch, summary):
+    """Upsert one batch of (line_number, user_id, book_id, rating) in one transaction"""
+    user_ids = {user_id for _, user_id, _, _ in batch}
+    book_ids = {book_id for _, _, book_id, _ in batch}
+    known_users = set(db.session.scalars(db.select(User.id).where(User.id.in_(user_ids))))
+    known_books = set(db.session.scalars(db.select(Book.id).where(Book.id.in_(book_ids))))
+
+    # Later events for the same user and book win
+    latest = {}
+    for line_number, user_id, book_id, rating in batch:
+        if user_id not in known_users or book_id not in known_books:
+            _record_error(summary, line_number, f"unknown user {user_id} or book {book_id}")
+            continue
+        latest[(user_id, book_id)] = rating
+
+    if latest:
+        rows = [
+            {'user_id': user_id, 'book_id': book_id, 'rating': rating}
+            for (user_id, book_id), rating in latest.items()
+        ]
+        _upsert_ratings(rows)
+        Book.recalculate_average_ratings({book_id for _, book_id in latest})
+        invalidate_precomputed_recommendations({user_id for user_id, _ in latest})
+    db.session.commit()
+
+    summary['upserted'] += len(latest)
+    summary['batches'] += 1
+
+
+def _record_error(summary, line_number, message):
+    summary['rejected'] += 1
+    if len(summary['errors']) < MAX_REPORTED_ERRORS:
+        summary['errors'].append({'line': line_number, 'error': message})
+
+
+def ingest_ratings(events, batch_size=5000):
+    """
+    Upsert a stream of rating events in batched transactions.
+
+    Each batch is one upsert against the ``_user_book_uc`` unique constraint
+    (see _upsert_ratings()) followed by one aggregate update of the affected
+    books' averages, so memory stays bounded by ``batch_size`` however long
+    the stream is. Must run inside an application context.
+
+    Args:
+        events: Iterable from iter_rating_events()
+        batch_size: Events per transaction (at least 1)
+
+    Returns:
+        Summary dict with received/upserted/rejected counts and the first
+        few errors by line number
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    summary = {'received': 0, 'upserted': 0, 'rejected': 0, 'batches': 0, 'errors': []}
+    events = iter(events)
+    while True:
+        chunk = list(islice(events, batch_size))
+        if not chunk:
+            break
+
+        batch = []
+        for line_number, event in chunk:
+            summary['received'] += 1
+            if isinstance(event, RatingEventError):
+                _record_error(summary, line_number, str(event))
+            else:
+                batch.append((line_number, *event))
+        if batch:
+            _ingest_batch(batch, summary)
+
+    return summary
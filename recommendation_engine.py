@@ -1,196 +1,1183 @@
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+from sklearn.utils.extmath import safe_sparse_dot
+
+from content_features import IncrementalTfidf, book_text
+from matrix_factorization import als_factorize, fold_in_user, svd_factorize
+from metrics import CACHE_REQUESTS, MODEL_BYTES, MODEL_SIZE, STAGE_SECONDS, TRAIN_SECONDS
+
+# Blocks of at most this many rows are multiplied against the feature matrix
+# in the other orientation, which avoids converting the whole matrix
+SMALL_BLOCK_ROWS = 32
+
+
+def _top_n_indices(scores, n):
+    """
+    Return the indices of the ``n`` highest finite scores, best first.
+    
+    Uses a partial sort (argpartition) so the cost is linear in the number of
+    scores; ties are broken by lower index, matching a stable descending sort.
+    """
+    candidates = np.flatnonzero(np.isfinite(scores))
+    if n <= 0 or len(candidates) == 0:
+        return candidates[:0]
+    if len(candidates) > n:
+        kth = np.partition(scores[candidates], -n)[-n]
+        candidates = candidates[scores[candidates] >= kth]
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order][:n]
+
+
+def _apply_mask(scores, mask):
+    """
+    Set the scores of books not selected by ``mask`` to NaN in place, along
+    the last axis. Books added after the mask was built count as unselected.
+    """
+    n = min(scores.shape[-1], len(mask))
+    scores[..., :n][..., ~mask[:n]] = np.nan
+    scores[..., n:] = np.nan
+
+
+def _min_max_normalize(scores):
+    """
+    Scale the finite scores of each row (last axis) to [0, 1] in place; a row
+    whose finite scores are all equal maps them to 1. NaN stays NaN.
+    """
+    finite = np.isfinite(scores)
+    low = np.where(finite, scores, np.inf).min(axis=-1, keepdims=True)
+    high = np.where(finite, scores, -np.inf).max(axis=-1, keepdims=True)
+    span = high - low
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scaled = np.where(span > 0, (scores - low) / span, 1.0)
+    scores[...] = np.where(finite, scaled, np.nan)
+    return scores
+
+
+def _map_row_blocks(func, n_rows, block_size, n_jobs=1):
+    """
+    Call ``func(start, end)`` for consecutive blocks of ``block_size`` rows,
+    on a pool of ``n_jobs`` threads when ``n_jobs`` > 1. The sparse products,
+    partitions and sorts inside a block release the GIL, so blocks run
+    concurrently on separate cores.
+    """
+    blocks = [(start, min(start + block_size, n_rows)) for start in range(0, n_rows, block_size)]
+    if n_jobs > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(lambda block: func(*block), blocks))
+    else:
+        for start, end in blocks:
+            func(start, end)
+
+
+def _blocked_top_k(features, k, block_size=1024, n_jobs=1, dtype=np.float32):
+    """
+    Find the ``k`` most cosine-similar rows for every row of ``features``.
+    
+    Similarities are computed one block of rows at a time (on ``n_jobs``
+    threads) and only the top-k of each block is kept, so the full N x N
+    matrix never exists in memory; peak memory is about ``n_jobs`` blocks.
+    Returns ``(neighbors, scores)`` arrays of shape (N, k), best first, with
+    each row's own index excluded.
+    """
+    n_rows = features.shape[0]
+    k = min(k, n_rows - 1)
+    neighbors = np.zeros((n_rows, max(k, 0)), dtype=np.int32)
+    scores = np.zeros((n_rows, max(k, 0)), dtype=dtype)
+    if k <= 0:
+        return neighbors, scores
+    normalized = normalize(features)
+    
+    def top_k_block(start, end):
+        neighbors[start:end], scores[start:end] = _top_k_rows(normalized, np.arange(start, end), k)
+    
+    _map_row_blocks(top_k_block, n_rows, block_size, n_jobs)
+    return neighbors, scores
+
+
+def _top_k_rows(normalized, rows, k):
+    """
+    Top-k neighbours of the given ``rows`` of L2-normalized ``features``,
+    best first with ties broken by lower index, excluding each row itself.
+    """
+    if len(rows) <= SMALL_BLOCK_ROWS:
+        block = np.ascontiguousarray(safe_sparse_dot(normalized, normalized[rows].T, dense_output=True).T)
+    else:
+        block = safe_sparse_dot(normalized[rows], normalized.T, dense_output=True)
+    return _top_k_of_block(block, rows, k)
+
+
+def _top_k_of_block(block, rows, k):
+    """
+    Top-k columns of each row of a dense similarity ``block`` computed for
+    ``rows``, as returned by _top_k_rows(). Overwrites the rows' own columns.
+    """
+    block[np.arange(len(rows)), rows] = -np.inf  # Exclude self
+    
+    top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+    top.sort(axis=1)  # Break ties by lower index
+    top_scores = np.take_along_axis(block, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def _matrix_top_k(similarities, k, block_size=1024):
+    """Top-k lists of every row of a dense similarity matrix, as returned by _blocked_top_k()"""
+    n_rows = similarities.shape[0]
+    k = max(min(k, n_rows - 1), 0)
+    neighbors = np.zeros((n_rows, k), dtype=np.int32)
+    scores = np.zeros((n_rows, k), dtype=similarities.dtype)
+    if k == 0:
+        return neighbors, scores
+    
+    def top_k_block(start, end):
+        block = np.array(similarities[start:end])
+        neighbors[start:end], scores[start:end] = _top_k_of_block(block, np.arange(start, end), k)
+    
+    _map_row_blocks(top_k_block, n_rows, block_size)
+    return neighbors, scores
+
+
+def _insert_neighbor(neighbors, scores, rows, neighbor, neighbor_scores):
+    """
+    Insert ``neighbor`` with ``neighbor_scores`` into the top-k lists of
+    ``rows`` in place, dropping the weakest entry of each list.
+    """
+    if len(rows) == 0:
+        return
+    k = neighbors.shape[1]
+    merged = np.hstack([neighbors[rows], np.full((len(rows), 1), neighbor, dtype=neighbors.dtype)])
+    merged_scores = np.hstack([scores[rows], np.asarray(neighbor_scores, dtype=scores.dtype)[:, None]])
+    order = np.argsort(-merged_scores, axis=1, kind='stable')[:, :k]
+    neighbors[rows] = np.take_along_axis(merged, order, axis=1)
+    scores[rows] = np.take_along_axis(merged_scores, order, axis=1)
+
+
+def _grown_capacity(needed, current, minimum=64):
+    """Capacity for a preallocated buffer that must hold ``needed`` items, growing geometrically"""
+    return max(needed, current + current // 2, minimum)
+
+
+def _merge_neighbors(neighbors, scores, overlay, overlay_users, user_indices, k):
+    """
+    Current top-k neighbours of users whose ratings did not change since
+    training.
+    
+    ``neighbors`` and ``scores`` are the users' top-k lists from training.
+    ``overlay`` holds the complete current similarity row of every user in
+    ``overlay_users`` (users whose ratings changed since training, new users
+    included), which supersedes their entries in the stored lists. Returns
+    ``(neighbors, scores, complete)``: ``complete`` is False for users whose
+    stored list lost so many overlay users that fewer than ``k`` of its
+    entries are still current, and whose rows must be recomputed.
+    """
+    candidates = neighbors.astype(np.int64)
+    candidate_scores = scores.astype(np.float64)
+    stale = np.isin(candidates, overlay_users)
+    candidate_scores[stale] = -np.inf
+    complete = neighbors.shape[1] - stale.sum(axis=1) >= k
+    if len(overlay_users):
+        candidates = np.hstack([candidates, np.broadcast_to(overlay_users, (len(user_indices), len(overlay_users)))])
+        candidate_scores = np.hstack([candidate_scores, overlay[:, user_indices].T])
+    
+    order = np.lexsort((candidates, -candidate_scores), axis=-1)[:, :k]  # Ties by lower index
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_scores, order, axis=1), complete
+
+
+def _approximate_top_k(features, k):
+    """
+    Approximate top-k cosine neighbours using pynndescent, for catalogs too
+    large for the exact blocked search. Returns the same arrays as
+    _blocked_top_k().
+    """
+    try:
+        from pynndescent import NNDescent
+    except ImportError as e:
+        raise ImportError("Approximate content index requires the 'pynndescent' package") from e
+    
+    n_rows = features.shape[0]
+    k = min(k, n_rows - 1)
+    index = NNDescent(features, metric='cosine', n_neighbors=k + 1)
+    graph_neighbors, graph_distances = index.neighbor_graph
+    
+    neighbors = np.zeros((n_rows, k), dtype=np.int32)
+    scores = np.zeros((n_rows, k), dtype=np.float32)
+    for row in range(n_rows):
+        keep = graph_neighbors[row] != row
+        row_neighbors = graph_neighbors[row][keep][:k]
+        neighbors[row, :len(row_neighbors)] = row_neighbors
+        scores[row, :len(row_neighbors)] = 1 - graph_distances[row][keep][:k]
+    return neighbors, scores
+
+
+SNAPSHOT_FORMAT_VERSION = 3
+
+# Ratings of new (user, book) pairs buffered by apply_rating() before they
+# are merged into the CSR user-book matrix
+RATING_DELTA_MERGE_SIZE = 10000
+
+# User-based CF keeps this many times n_neighbors similar users per user, so
+# neighbours whose ratings change after training can be dropped from the list
+USER_NEIGHBOR_FACTOR = 2
+
+
+class BookCatalog:
+    """
+    In-memory cache of serialized books, aligned with the content model rows.
+    
+    Built once at training time from the same query that feeds the content
+    model, so row ``i`` of the catalog is always row ``i`` of the content
+    neighbour index. Books added later are appended; removed books keep their
+    row (as None) so the alignment never shifts. ``version`` increases on
+    every change, ``rows_version`` only when a book is added or removed
+    (not when one is updated in place, e.g. with a new average rating).
+    
+    Genre, author and year are also kept as arrays aligned with the rows, so
+    mask() can select the books matching a filter with a few vectorized
+    comparisons.
+    """
+    
+    def __init__(self, books=(), version=0):
+        self.version = version
+        self.rows_version = 0
+        self._books = list(books)
+        self.book_ids = np.array([book['id'] if book else -1 for book in self._books], dtype=np.int64)
+        self.id_to_idx = {book['id']: idx for idx, book in enumerate(self._books) if book}
+        self._lock = threading.Lock()
+        
+        # Attribute indexes: genre/author codes (-1 for removed rows) and years (NaN if unknown)
+        self._attribute_codes = {'genre': {}, 'author': {}}
+        attributes = [self._attribute_row(book) for book in self._books]
+        self.genre_codes = np.array([row[0] for row in attributes], dtype=np.int32)
+        self.author_codes = np.array([row[1] for row in attributes], dtype=np.int32)
+        self.years = np.array([row[2] for row in attributes], dtype=np.float64)
+    
+    def _attribute_row(self, book):
+        """(genre code, author code, year) of a serialized book for the attribute indexes"""
+        if book is None:
+            return -1, -1, np.nan
+        return (
+            self._attribute_code('genre', book['genre']),
+            self._attribute_code('author', book['author']),
+            np.nan if book['year'] is None else float(book['year'])
+        )
+    
+    def _attribute_code(self, attribute, value):
+        codes = self._attribute_codes[attribute]
+        return codes.setdefault(str(value).casefold(), len(codes))
+    
+    def __len__(self):
+        return len(self.id_to_idx)
+    
+    def __contains__(self, book_id):
+        return book_id in self.id_to_idx
+    
+    def get(self, book_id):
+        """Return the serialized book, or None if it is not in the catalog"""
+        idx = self.id_to_idx.get(book_id)
+        return self._books[idx] if idx is not None else None
+    
+    def get_many(self, book_ids):
+        """Return serialized books for ``book_ids`` in order, skipping unknown ids"""
+        books = [self.get(book_id) for book_id in book_ids]
+        found = [book for book in books if book is not None]
+        if books:
+            CACHE_REQUESTS.inc(len(found), cache='catalog', result='hit')
+            CACHE_REQUESTS.inc(len(books) - len(found), cache='catalog', result='miss')
+        return found
+    
+    def upsert(self, book):
+        """Insert or replace a serialized book"""
+        with self._lock:
+            idx = self.id_to_idx.get(book['id'])
+            genre_code, author_code, year = self._attribute_row(book)
+            if idx is None:
+                self._books.append(book)
+                self.book_ids = np.append(self.book_ids, book['id'])
+                self.genre_codes = np.append(self.genre_codes, np.int32(genre_code))
+                self.author_codes = np.append(self.author_codes, np.int32(author_code))
+                self.years = np.append(self.years, year)
+                self.id_to_idx[book['id']] = len(self._books) - 1
+                self.rows_version += 1
+            else:
+                self._books[idx] = book
+                self.genre_codes[idx] = genre_code
+                self.author_codes[idx] = author_code
+                self.years[idx] = year
+            self.version += 1
+    
+    def remove(self, book_id):
+        """Remove a book, keeping its row so indices stay aligned"""
+        with self._lock:
+            idx = self.id_to_idx.pop(book_id, None)
+            if idx is not None:
+                self._books[idx] = None
+                self.genre_codes[idx] = -1
+                self.author_codes[idx] = -1
+                self.years[idx] = np.nan
+                self.version += 1
+                self.rows_version += 1
+    
+    def mask(self, genres=(), authors=(), min_year=None, max_year=None):
+        """
+        Boolean array over the rows selecting the books that are in the
+        catalog and match every given condition: any of ``genres``, any of
+        ``authors`` (both case-insensitive) and a year within
+        [min_year, max_year]. Books without a year never match a year bound.
+        """
+        with self._lock:
+            mask = self.genre_codes >= 0
+            for attribute, codes, values in (('genre', self.genre_codes, genres),
+                                             ('author', self.author_codes, authors)):
+                if values:
+                    known = self._attribute_codes[attribute]
+                    wanted = [known[key] for key in (str(value).casefold() for value in values) if key in known]
+                    mask &= np.isin(codes, wanted)
+            if min_year is not None:
+                mask &= self.years >= min_year
+            if max_year is not None:
+                mask &= self.years <= max_year
+            return mask
+    
+    def rows(self):
+        """Serialized books by row, with None for removed books"""
+        return list(self._books)
+
 
 class HybridRecommender:
     """
     Hybrid Recommendation System combining:
-    1. Collaborative Filtering (User-based)
+    1. Collaborative Filtering (User-based, Item-based or Matrix Factorization)
     2. Content-based Filtering (based on book features)
     """
     
-    def __init__(self):
-        self.user_similarity_matrix = None
-        self.content_similarity_matrix = None
+    def __init__(self, n_neighbors=10, content_neighbors=50, content_index='exact', block_size=1024,
+                 collaborative='user', item_neighbors=50, factorization='als', n_factors=32, n_jobs=1,
+                 content_vectorizer='tfidf', fusion='score'):
+        """
+        Args:
+            n_neighbors: Number of similar users used to predict a rating
+            content_neighbors: Number of similar books kept per book
+            content_index: 'exact' for a blocked exact top-k search, or
+                'approximate' for an approximate nearest-neighbour index
+                (requires pynndescent) on very large catalogs
+            block_size: Rows per block when computing similarities; bounds
+                the memory of each top-k search block to block_size x rows
+            collaborative: 'user' for user-based CF (the top similar users
+                of each user), or 'item' for item-based CF over
+                precomputed top-k book neighbourhoods, which scales to many
+                more users and does not change when users rate books
+            item_neighbors: Number of co-rated neighbour books kept per book
+                by item-based CF
+            factorization: 'als' or 'svd' (truncated SVD), used when
+                ``collaborative`` is 'mf' to learn latent user and book factors;
+                a user is then scored with one factor-vector product
+            n_factors: Latent dimensions of the factorization
+            n_jobs: Worker threads for training: similarity blocks and ALS
+                solves are spread over this many cores
+            content_vectorizer: 'tfidf' to fit a TF-IDF vocabulary (top 100
+                terms) at training time, or 'hashing' for hashed TF-IDF
+                features with maintained document frequencies, which lets
+                new and edited books join the content index immediately
+            fusion: 'score' to blend normalized collaborative and content
+                scores in one pass over a shared candidate set, or 'rank' to
+                merge the two top-2N lists by rank position
+        """
+        if content_index not in ('exact', 'approximate'):
+            raise ValueError(f"Unknown content_index: {content_index}")
+        if collaborative not in ('user', 'item', 'mf'):
+            raise ValueError(f"Unknown collaborative backend: {collaborative}")
+        if factorization not in ('als', 'svd'):
+            raise ValueError(f"Unknown factorization: {factorization}")
+        if content_vectorizer not in ('tfidf', 'hashing'):
+            raise ValueError(f"Unknown content_vectorizer: {content_vectorizer}")
+        if fusion not in ('score', 'rank'):
+            raise ValueError(f"Unknown fusion: {fusion}")
+        self.n_neighbors = n_neighbors
+        self.content_neighbors = content_neighbors
+        self.content_index = content_index
+        self.block_size = block_size
+        self.collaborative = collaborative
+        self.item_neighbors = item_neighbors
+        self.factorization = factorization
+        self.n_factors = n_factors
+        self.n_jobs = n_jobs
+        self.content_vectorizer = content_vectorizer
+        self.fusion = fusion
+        self.content_features = None
+        self.user_neighbor_indices = None
+        self.user_neighbor_scores = None
+        self.user_factors = None
+        self.item_factors = None
+        self.item_neighbor_indices = None
+        self.item_neighbor_scores = None
+        self._item_graph = None
+        self.content_neighbor_indices = None
+        self.content_neighbor_scores = None
+        self._content_neighbor_buffers = None
+        self._content_graphs = None
+        self.content_version = 0  # Bumped whenever update_catalog() changes the content index
+        self._catalog_rows = None
+        self.catalog = BookCatalog()
+        self.vectorizer = None
+        self.tfidf_matrix = None
         self.user_book_matrix = None
-        self.book_ids = []
-        self.user_ids = []
+        self.user_norms = None
+        self._reset_incremental_state()
+        self.book_ids = np.array([], dtype=np.int64)
+        self.user_ids = np.array([], dtype=np.int64)
+        self.user_id_to_idx = {}
+        self.book_id_to_idx = {}
+        self.trained_at = None
+        self._lock = threading.RLock()
         
     def train(self):
-        """Train both collaborative and content-based models"""
+        """
+        Train both collaborative and content-based models. ``trained_at`` is
+        when loading the training data started, so ratings committed while
+        training are newer than it and picked up by a catch-up.
+        """
         print("Training recommendation engine...")
-        self._train_collaborative_filtering()
-        self._train_content_based()
+        started_at = time.time()
+        with TRAIN_SECONDS.time():
+            self._train_collaborative_filtering()
+            self._train_content_based()
+        self.trained_at = started_at
+        self._record_model_size()
         print("Training complete!")
     
+    def _record_model_size(self):
+        """Publish model dimensions and array memory as metrics"""
+        MODEL_SIZE.set(len(self.user_ids), dimension='users')
+        MODEL_SIZE.set(len(self.catalog), dimension='books')
+        if self.user_book_matrix is not None:
+            matrix = self.user_book_matrix
+            MODEL_SIZE.set(matrix.nnz, dimension='ratings')
+            MODEL_BYTES.set(matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes,
+                            component='user_book_matrix')
+        if self.user_neighbor_indices is not None:
+            MODEL_BYTES.set(self.user_neighbor_indices.nbytes + self.user_neighbor_scores.nbytes,
+                            component='user_neighbor_index')
+        if self.item_neighbor_indices is not None:
+            MODEL_BYTES.set(self.item_neighbor_indices.nbytes + self.item_neighbor_scores.nbytes,
+                            component='item_neighbor_index')
+        if self.user_factors is not None:
+            MODEL_BYTES.set(self.user_factors.nbytes + self.item_factors.nbytes, component='latent_factors')
+        if self.content_neighbor_indices is not None:
+            MODEL_BYTES.set(self.content_neighbor_indices.nbytes + self.content_neighbor_scores.nbytes,
+                            component='content_neighbor_index')
+    
     def _train_collaborative_filtering(self):
         """Train collaborative filtering model using user-item matrix"""
-        from models import Rating
-        # Get all ratings
-        ratings = Rating.query.all()
-        if not ratings:
+        from training_data import load_rating_arrays
+        # Get all ratings as typed column arrays
+        with STAGE_SECONDS.time(stage='load_ratings'):
+            user_col, book_col, rating_col = load_rating_arrays()
+        if len(user_col) == 0:
             print("No ratings found for training")
             return
         
-        # Create user-book matrix
-        rating_data = [{
-            'user_id': r.user_id,
-            'book_id': r.book_id,
-            'rating': r.rating
-        } for r in ratings]
-        
-        df = pd.DataFrame(rating_data)
-        
-        # Create pivot table (user-book matrix)
-        self.user_book_matrix = df.pivot_table(
-            index='user_id',
-            columns='book_id',
-            values='rating',
-            fill_value=0
-        )
-        
-        self.user_ids = self.user_book_matrix.index.tolist()
-        self.book_ids = self.user_book_matrix.columns.tolist()
+        self._reset_incremental_state()
+        with STAGE_SECONDS.time(stage='build_matrix'):
+            # Map ids to dense row/column indices (sorted, like the old pivot table)
+            self.user_ids, user_rows = np.unique(user_col, return_inverse=True)
+            self.book_ids, book_cols = np.unique(book_col, return_inverse=True)
+            self.user_id_to_idx = {int(uid): idx for idx, uid in enumerate(self.user_ids)}
+            self.book_id_to_idx = {int(bid): idx for idx, bid in enumerate(self.book_ids)}
+            
+            # Create sparse user-book matrix (users x books, 0 = not rated)
+            self.user_book_matrix = sparse.csr_matrix(
+                (rating_col.astype(np.float64), (user_rows, book_cols)),
+                shape=(len(self.user_ids), len(self.book_ids))
+            )
+            self.user_book_matrix.sum_duplicates()
+            squared = self.user_book_matrix.multiply(self.user_book_matrix)
+            self.user_norms = np.sqrt(np.asarray(squared.sum(axis=1)).ravel())
         
-        # Calculate user similarity matrix using cosine similarity
-        if len(self.user_ids) > 1:
-            self.user_similarity_matrix = cosine_similarity(self.user_book_matrix)
+        if self.collaborative == 'item':
+            # Top-k co-rating (cosine over the users who rated both) neighbours per book
+            with STAGE_SECONDS.time(stage='item_similarity'):
+                self.item_neighbor_indices, self.item_neighbor_scores = _blocked_top_k(
+                    self.user_book_matrix.T.tocsr(), self.item_neighbors, self.block_size, self.n_jobs
+                )
+            self._item_graph = None
+        elif self.collaborative == 'mf':
+            with STAGE_SECONDS.time(stage='factorization'):
+                if self.factorization == 'svd':
+                    self.user_factors, self.item_factors = svd_factorize(self.user_book_matrix, self.n_factors)
+                else:
+                    self.user_factors, self.item_factors = als_factorize(
+                        self.user_book_matrix, self.n_factors, n_jobs=self.n_jobs
+                    )
         else:
-            self.user_similarity_matrix = np.array([[1.0]])
+            # Keep the most cosine-similar users of each user, block by block
+            with STAGE_SECONDS.time(stage='user_similarity'):
+                self.user_neighbor_indices, self.user_neighbor_scores = _blocked_top_k(
+                    self.user_book_matrix, USER_NEIGHBOR_FACTOR * self.n_neighbors,
+                    self.block_size, self.n_jobs, dtype=np.float64
+                )
         
         print(f"Collaborative filtering trained with {len(self.user_ids)} users and {len(self.book_ids)} books")
     
+    def apply_rating(self, user_id, book_id, rating):
+        """
+        Incrementally apply a new or changed rating to the collaborative model.
+        
+        Changed ratings are patched into the user-book matrix in place and
+        new ones are buffered in a small delta; the affected user's similarity
+        row is recomputed into an overlay over the trained neighbour lists,
+        so new ratings are reflected immediately without a full retrain and
+        without copying either matrix. Item-based CF only
+        needs the matrix patch; book neighbourhoods are refreshed by the next
+        training run. Matrix factorization folds the user's ratings into new
+        user factors against the fixed book factors. Unknown users and books
+        are appended to the model.
+        """
+        with self._lock, STAGE_SECONDS.time(stage='apply_rating'):
+            if self.user_book_matrix is None:
+                self.user_book_matrix = sparse.csr_matrix((0, 0), dtype=np.float64)
+                if self.collaborative == 'user':
+                    self.user_neighbor_indices = np.zeros((0, 0), dtype=np.int32)
+                    self.user_neighbor_scores = np.zeros((0, 0))
+                self.user_norms = np.zeros(0)
+            
+            if book_id not in self.book_id_to_idx:
+                self._add_book_column(book_id)
+            if user_id not in self.user_id_to_idx:
+                self._add_user_row(user_id)
+            
+            user_idx = self.user_id_to_idx[user_id]
+            book_idx = self.book_id_to_idx[book_id]
+            self._set_matrix_value(user_idx, book_idx, float(rating))
+            if self.collaborative == 'user':
+                self._update_user_similarity(user_idx)
+            elif self.collaborative == 'mf' and self.item_factors is not None:
+                self._fold_in_user(user_idx)
+    
+    def update_catalog(self, books=(), removed_ids=()):
+        """
+        Apply changed and deleted books to the catalog cache.
+        
+        New books become available for lookups immediately. With hashed
+        content features, new and edited books are also vectorized and
+        inserted into the content neighbour index right away (and removed
+        books dropped from it); otherwise they join the index at the next
+        training run.
+        """
+        with self._lock:
+            for book in books:
+                old = self.catalog.get(book['id'])
+                self.catalog.upsert(book)
+                if self.content_features is not None and (old is None or book_text(old) != book_text(book)):
+                    self._update_content_row(self.catalog.id_to_idx[book['id']], book_text(book))
+            for book_id in removed_ids:
+                book_idx = self.catalog.id_to_idx.get(book_id)
+                self.catalog.remove(book_id)
+                if self.content_features is not None and book_idx is not None:
+                    self._update_content_row(book_idx, '')
+    
+    def _update_content_row(self, book_idx, text):
+        """
+        Re-vectorize one catalog row (appending it if new) and update the
+        content neighbour index in place: the row's own neighbours, the rows
+        that listed it, and the rows it now beats the weakest neighbour of.
+        
+        Rows are weighted with the IDF fitted at training time, so one edit
+        touches a single row of the weight matrix. Rows that listed the book
+        only need their top-k recomputed (one block of rows at a time) when
+        its new similarity falls below their old weakest neighbour; otherwise
+        the updated score is just re-sorted into place.
+        """
+        with STAGE_SECONDS.time(stage='content_update'):
+            features = self.content_features
+            is_new = book_idx == len(features)
+            if is_new:
+                features.append(text)
+            elif book_idx < len(features):
+                features.replace(book_idx, text)
+            else:
+                return
+            
+            weights = features.weights()
+            k = min(self.content_neighbors, len(features) - 1)
+            if self.content_neighbor_indices is None or self.content_neighbor_indices.shape[1] != k:
+                # Neighbour lists are still growing on a tiny catalog; rebuild them
+                self.content_neighbor_indices, self.content_neighbor_scores = _blocked_top_k(
+                    weights, self.content_neighbors, self.block_size, self.n_jobs
+                )
+                self._content_neighbor_buffers = None
+                self._content_graphs = None
+                self.content_version += 1
+                return
+            
+            if is_new:
+                self._append_content_neighbor_row()
+            neighbors, scores = self.content_neighbor_indices, self.content_neighbor_scores
+            exact_similarities = safe_sparse_dot(weights, weights[book_idx].T, dense_output=True)
+            exact_similarities = np.asarray(exact_similarities).ravel()
+            similarities = exact_similarities.astype(scores.dtype)
+            weakest = scores[:, -1].copy()
+            
+            # Rows that listed the book keep it if it still beats their old weakest neighbour
+            listed_rows, listed_slots = np.nonzero(neighbors == book_idx)
+            kept = similarities[listed_rows] > weakest[listed_rows]
+            if not text:
+                kept[:] = False  # Removed books give up their place to the next candidate
+            kept_rows = listed_rows[kept]
+            scores[kept_rows, listed_slots[kept]] = similarities[kept_rows]
+            order = np.lexsort((neighbors[kept_rows], -scores[kept_rows]), axis=-1)
+            neighbors[kept_rows] = np.take_along_axis(neighbors[kept_rows], order, axis=1)
+            scores[kept_rows] = np.take_along_axis(scores[kept_rows], order, axis=1)
+            
+            # The book's own neighbours come from the similarities already computed
+            refresh = listed_rows[~kept]
+            neighbors[book_idx], scores[book_idx] = _top_k_of_block(exact_similarities[None, :], [book_idx], k)
+            
+            def refresh_block(start, end):
+                rows = refresh[start:end]
+                neighbors[rows], scores[rows] = _top_k_rows(weights, rows, k)
+            
+            _map_row_blocks(refresh_block, len(refresh), self.block_size, self.n_jobs)
+            
+            beaten = similarities > weakest
+            beaten[listed_rows] = False
+            beaten[book_idx] = False
+            rows = np.flatnonzero(beaten)
+            _insert_neighbor(neighbors, scores, rows, book_idx, similarities[rows])
+            self._content_graphs = None
+            self.content_version += 1
+    
+    def _append_content_neighbor_row(self):
+        """
+        Extend the content neighbour index by one empty row. The index arrays
+        are views of buffers grown geometrically, so appends do not copy it.
+        """
+        n_rows, k = self.content_neighbor_indices.shape
+        buffers = self._content_neighbor_buffers
+        if (buffers is None or len(buffers[0]) <= n_rows or
+                self.content_neighbor_indices.base is not buffers[0]):
+            capacity = _grown_capacity(n_rows + 1, n_rows)
+            buffers = tuple(
+                np.zeros((capacity, k), dtype=array.dtype)
+                for array in (self.content_neighbor_indices, self.content_neighbor_scores)
+            )
+            buffers[0][:n_rows] = self.content_neighbor_indices
+            buffers[1][:n_rows] = self.content_neighbor_scores
+            self._content_neighbor_buffers = buffers
+        self.content_neighbor_indices = buffers[0][:n_rows + 1]
+        self.content_neighbor_scores = buffers[1][:n_rows + 1]
+    
+    def _add_book_column(self, book_id):
+        """Append an empty column for a book unseen at training time"""
+        matrix = self.user_book_matrix
+        self.book_id_to_idx[book_id] = len(self.book_ids)
+        self.book_ids = np.append(self.book_ids, book_id)
+        self.user_book_matrix = sparse.csr_matrix(
+            (matrix.data, matrix.indices, matrix.indptr),
+            shape=(matrix.shape[0], matrix.shape[1] + 1)
+        )
+        self._item_graph = None
+        if self.item_factors is not None:
+            self.item_factors = np.vstack([self.item_factors, np.zeros((1, self.item_factors.shape[1]))])
+    
+    def _add_user_row(self, user_id):
+        """Append an empty row for a user unseen at training time"""
+        matrix = self.user_book_matrix
+        self.user_id_to_idx[user_id] = len(self.user_ids)
+        self.user_ids = np.append(self.user_ids, user_id)
+        self.user_book_matrix = sparse.csr_matrix(
+            (matrix.data, matrix.indices, np.append(matrix.indptr, matrix.indptr[-1])),
+            shape=(matrix.shape[0] + 1, matrix.shape[1])
+        )
+        if self.user_factors is not None:
+            self.user_factors = np.vstack([self.user_factors, np.zeros((1, self.user_factors.shape[1]))])
+        self.user_norms = np.append(self.user_norms, 0.0)
+    
+    def _reset_incremental_state(self):
+        """Drop the rating delta and the similarity overlay kept by apply_rating()"""
+        self._rating_delta = {}
+        self._rating_delta_matrix = None
+        self._similarity_overlay = np.zeros((0, 0))
+        self._overlay_users = np.zeros(0, dtype=np.int64)
+        self._similarity_slots = np.zeros(0, dtype=np.int64)
+    
+    def _set_matrix_value(self, user_idx, book_idx, value):
+        """
+        Set one rating: in place if the CSR matrix stores it already, else in
+        the delta of new ratings, which is merged into the matrix once it
+        holds RATING_DELTA_MERGE_SIZE entries (and at save and retrain)
+        """
+        matrix = self.user_book_matrix
+        start, end = matrix.indptr[user_idx], matrix.indptr[user_idx + 1]
+        row_indices = matrix.indices[start:end]
+        pos = start + np.searchsorted(row_indices, book_idx)
+        if pos < end and matrix.indices[pos] == book_idx:
+            matrix.data[pos] = value
+            return
+        
+        self._rating_delta[(user_idx, book_idx)] = value
+        self._rating_delta_matrix = None
+        if len(self._rating_delta) >= RATING_DELTA_MERGE_SIZE:
+            self.user_book_matrix = self._merged_ratings()
+            self._rating_delta = {}
+    
+    def _delta_matrix(self):
+        """The rating delta as a sparse matrix shaped like the user-book matrix, or None if empty"""
+        if not self._rating_delta:
+            return None
+        delta = self._rating_delta_matrix
+        if delta is None or delta.shape != self.user_book_matrix.shape:
+            keys = np.array(list(self._rating_delta), dtype=np.int64).reshape(-1, 2)
+            values = np.fromiter(self._rating_delta.values(), dtype=np.float64, count=len(keys))
+            delta = sparse.csr_matrix((values, (keys[:, 0], keys[:, 1])), shape=self.user_book_matrix.shape)
+            self._rating_delta_matrix = delta
+        return delta
+    
+    def _merged_ratings(self):
+        """The user-book matrix with the rating delta merged in"""
+        delta = self._delta_matrix()
+        if delta is None:
+            return self.user_book_matrix
+        merged = (self.user_book_matrix + delta).tocsr()
+        merged.sort_indices()
+        return merged
+    
+    def _rating_rows(self, user_indices):
+        """Current ratings of ``user_indices`` (matrix rows plus buffered new ratings)"""
+        rows = self.user_book_matrix[user_indices]
+        delta = self._delta_matrix()
+        return rows if delta is None else (rows + delta[user_indices]).tocsr()
+    
+    def _user_neighbors(self, user_indices, k):
+        """
+        Current top-k similar users of ``user_indices`` and their similarities,
+        as two (len(user_indices), k) arrays: the trained neighbour lists
+        merged with the overlay, or the overlay row itself for users whose
+        ratings changed.
+        """
+        user_indices = np.asarray(user_indices, dtype=np.int64)
+        n_slots = len(self._overlay_users)
+        overlay = self._similarity_overlay[:n_slots]
+        n_base, n_stored = self.user_neighbor_indices.shape
+        neighbours = np.zeros((len(user_indices), k), dtype=np.int64)
+        weights = np.zeros((len(user_indices), k))
+        
+        user_slots = np.full(len(user_indices), -1, dtype=np.int64)
+        known = user_indices < len(self._similarity_slots)
+        user_slots[known] = self._similarity_slots[user_indices[known]]
+        stored = (user_slots < 0) & (user_indices < n_base)
+        recompute = ~stored & (user_slots < 0)
+        
+        if stored.any():
+            rows = np.flatnonzero(stored)
+            users = user_indices[rows]
+            neighbours[rows], weights[rows], complete = _merge_neighbors(
+                self.user_neighbor_indices[users], self.user_neighbor_scores[users],
+                overlay, self._overlay_users, users, k
+            )
+            if n_stored < n_base - 1:
+                recompute[rows[~complete]] = True
+        
+        has_slot = np.flatnonzero(user_slots >= 0)
+        if len(has_slot):
+            block = np.array(overlay[user_slots[has_slot], :len(self.user_ids)])
+            neighbours[has_slot], weights[has_slot] = _top_k_of_block(block, user_indices[has_slot], k)
+        for row in np.flatnonzero(recompute):
+            similarities = self._current_similarities(user_indices[row])[None, :]
+            neighbours[row], weights[row] = _top_k_of_block(similarities, user_indices[row:row + 1], k)
+        return neighbours, weights
+    
+    def _similarity_slot(self, user_idx):
+        """Overlay row of a user, allocating it (and growing the overlay geometrically) if needed"""
+        n_users = len(self.user_ids)
+        if len(self._similarity_slots) < n_users:
+            slots = np.full(_grown_capacity(n_users, len(self._similarity_slots)), -1, dtype=np.int64)
+            slots[:len(self._similarity_slots)] = self._similarity_slots
+            self._similarity_slots = slots
+        
+        n_slots = len(self._overlay_users)
+        rows_needed = n_slots + (self._similarity_slots[user_idx] < 0)
+        overlay = self._similarity_overlay
+        if overlay.shape[0] < rows_needed or overlay.shape[1] < n_users:
+            grown = np.zeros((
+                _grown_capacity(rows_needed, overlay.shape[0]) if overlay.shape[0] < rows_needed else overlay.shape[0],
+                _grown_capacity(n_users, overlay.shape[1]) if overlay.shape[1] < n_users else overlay.shape[1]
+            ))
+            grown[:n_slots, :overlay.shape[1]] = overlay[:n_slots]
+            self._similarity_overlay = grown
+        
+        if self._similarity_slots[user_idx] < 0:
+            self._similarity_slots[user_idx] = n_slots
+            self._overlay_users = np.append(self._overlay_users, user_idx)
+        return self._similarity_slots[user_idx]
+    
+    def _current_similarities(self, user_idx):
+        """Cosine similarities of one user's current ratings to every user's"""
+        user_row = self._rating_rows([user_idx]).toarray().ravel()
+        dots = self.user_book_matrix @ user_row
+        delta = self._delta_matrix()
+        if delta is not None:
+            dots += delta @ user_row
+        
+        denominators = self.user_norms * np.sqrt(user_row @ user_row)
+        similarities = np.zeros(len(dots))
+        nonzero = denominators > 0
+        similarities[nonzero] = dots[nonzero] / denominators[nonzero]
+        return similarities
+    
+    def _update_user_similarity(self, user_idx):
+        """
+        Recompute the cosine similarities of one user into the overlay: the
+        user's own row, and the entries of the other overlay rows for them
+        """
+        user_row = self._rating_rows([user_idx])
+        self.user_norms[user_idx] = np.sqrt(user_row.multiply(user_row).sum())
+        similarities = self._current_similarities(user_idx)
+        
+        slot = self._similarity_slot(user_idx)
+        self._similarity_overlay[slot, :len(similarities)] = similarities
+        self._similarity_overlay[:len(self._overlay_users), user_idx] = similarities[self._overlay_users]
+    
+    def _fold_in_user(self, user_idx):
+        """Recompute one user's latent factors from their current ratings"""
+        row = self._rating_rows([user_idx])
+        self.user_factors[user_idx] = fold_in_user(
+            row.indices, row.data, self.item_factors, method=self.factorization
+        )
+    
     def _train_content_based(self):
         """Train content-based model using book features"""
-        from models import Book
-        books = Book.query.all()
-        if not books:
+        from training_data import iter_book_rows
+        with STAGE_SECONDS.time(stage='load_books'):
+            # Create feature vectors from book metadata, and the catalog rows
+            # from the same query so both stay aligned
+            book_features = []
+            book_rows = []
+            
+            for book in iter_book_rows():
+                book_features.append(book_text(book))
+                book_rows.append(book)
+        if not book_rows:
             print("No books found for training")
             return
         
-        # Create feature vectors from book metadata
-        book_features = []
-        book_ids = []
+        # Use TF-IDF to vectorize book features
+        with STAGE_SECONDS.time(stage='tfidf_fit'):
+            if self.content_vectorizer == 'hashing':
+                self.content_features = IncrementalTfidf().fit(book_features)
+                tfidf_matrix = self.content_features.weights()
+            else:
+                vectorizer = TfidfVectorizer(stop_words='english', max_features=100)
+                tfidf_matrix = vectorizer.fit_transform(book_features).tocsr()
+                self.vectorizer = vectorizer
+                self.tfidf_matrix = tfidf_matrix
+        self.catalog = BookCatalog(book_rows, version=self.catalog.version + 1)
         
-        for book in books:
-            # Combine text features, handling None values
-            description = book.description if book.description else ''
-            features = f"{book.genre} {book.author} {description}"
-            book_features.append(features)
-            book_ids.append(book.id)
+        # Build the top-k similar books index
+        with STAGE_SECONDS.time(stage='content_index'):
+            if self.content_index == 'approximate':
+                neighbors, scores = _approximate_top_k(tfidf_matrix, self.content_neighbors)
+            else:
+                neighbors, scores = _blocked_top_k(
+                    tfidf_matrix, self.content_neighbors, self.block_size, self.n_jobs
+                )
+        self.content_neighbor_indices = neighbors
+        self.content_neighbor_scores = scores
+        self._content_neighbor_buffers = None
+        self._content_graphs = None
         
-        # Use TF-IDF to vectorize book features
-        vectorizer = TfidfVectorizer(stop_words='english', max_features=100)
-        tfidf_matrix = vectorizer.fit_transform(book_features)
+        print(f"Content-based filtering trained with {len(book_rows)} books")
+    
+    def _collaborative_scores(self, user_idx):
+        """
+        Predict ratings for every book for the user at row ``user_idx``.
+        
+        Uses a weighted average of the ratings given by the top similar users.
+        Returns an array aligned with ``self.book_ids`` holding NaN for books
+        that cannot be predicted or are already rated by the user.
+        """
+        return self._collaborative_score_block([user_idx])[0]
+    
+    def _collaborative_score_block(self, user_indices):
+        """
+        Predict ratings for a block of users (rows of the user-book matrix).
+        
+        Returns a (len(user_indices), books) array, NaN where there is no
+        prediction or the user already rated. Item-based CF and matrix
+        factorization are scored by _item_score_block() and
+        _factor_score_block(). For user-based CF, the top similar users of
+        every user in the block are gathered into one sparse neighbour-weight
+        matrix, so the whole block is scored with a single weights x ratings
+        product.
+        """
+        if self.collaborative == 'item':
+            return self._item_score_block(user_indices)
+        if self.collaborative == 'mf':
+            return self._factor_score_block(user_indices)
+        
+        matrix = self.user_book_matrix
+        user_indices = np.asarray(user_indices, dtype=np.int64)
+        n_block = len(user_indices)
+        scores = np.full((n_block, matrix.shape[1]), np.nan)
+        
+        # Get similar users (excluding the users themselves)
+        k = min(self.n_neighbors, matrix.shape[0] - 1)
+        if k <= 0 or n_block == 0:
+            return scores
+        neighbours, weights = self._user_neighbors(user_indices, k)
+        positive = weights > 0
+        if not positive.any():
+            return scores
+        
+        # Neighbour weights as a sparse (block x distinct neighbours) matrix
+        block_rows = np.repeat(np.arange(n_block), k)[positive.ravel()]
+        distinct_neighbours, neighbour_cols = np.unique(neighbours[positive], return_inverse=True)
+        weight_matrix = sparse.csr_matrix(
+            (weights[positive], (block_rows, neighbour_cols)),
+            shape=(n_block, len(distinct_neighbours))
+        )
         
-        # Calculate book similarity matrix
-        self.content_similarity_matrix = cosine_similarity(tfidf_matrix)
+        # Weighted sum of neighbour ratings and sum of weights of neighbours who rated each book
+        neighbour_ratings = self._rating_rows(distinct_neighbours)
+        weighted_sums = (weight_matrix @ neighbour_ratings).toarray()
+        rated_by_neighbour = neighbour_ratings.copy()
+        rated_by_neighbour.data = (rated_by_neighbour.data > 0).astype(np.float64)
+        total_similarities = (weight_matrix @ rated_by_neighbour).toarray()
         
-        print(f"Content-based filtering trained with {len(books)} books")
+        predictable = total_similarities > 0
+        scores[predictable] = weighted_sums[predictable] / total_similarities[predictable]
+        
+        # Exclude books the users have already rated
+        rated_rows, rated_cols = self._rating_rows(user_indices).nonzero()
+        scores[rated_rows, rated_cols] = np.nan
+        return scores
     
-    def _collaborative_recommendations(self, user_id, n_recommendations=10):
-        """Get recommendations using collaborative filtering"""
-        if self.user_similarity_matrix is None or user_id not in self.user_ids:
-            return []
+    def _item_neighbor_graph(self):
+        """
+        The item neighbour index as a sparse (books x books) matrix holding
+        the similarity of each book to its neighbours, sized to the current
+        user-book matrix. Built on first use after training.
+        """
+        if self._item_graph is None:
+            n_books = self.user_book_matrix.shape[1]
+            n_indexed, k = self.item_neighbor_indices.shape
+            rows = np.repeat(np.arange(n_indexed), k)
+            cols = self.item_neighbor_indices.ravel()
+            weights = self.item_neighbor_scores.ravel().astype(np.float64)
+            positive = weights > 0
+            self._item_graph = sparse.csr_matrix(
+                (weights[positive], (rows[positive], cols[positive])),
+                shape=(n_books, n_books)
+            )
+        return self._item_graph
+    
+    def _item_score_block(self, user_indices):
+        """
+        Item-based CF predictions for a block of users: for every book, the
+        similarity-weighted average of the user's ratings of the books that
+        list it as a neighbour. Same shape and NaN convention as
+        _collaborative_score_block().
+        """
+        matrix = self.user_book_matrix
+        user_indices = np.asarray(user_indices, dtype=np.int64)
+        scores = np.full((len(user_indices), matrix.shape[1]), np.nan)
+        if len(user_indices) == 0 or self.item_neighbor_indices is None:
+            return scores
         
-        # Get user index
-        user_idx = self.user_ids.index(user_id)
+        graph = self._item_neighbor_graph()
+        user_ratings = self._rating_rows(user_indices)
+        weighted_sums = (user_ratings @ graph).toarray()
+        rated = user_ratings.copy()
+        rated.data = (rated.data > 0).astype(np.float64)
+        total_similarities = (rated @ graph).toarray()
         
-        # Get similar users (excluding the user themselves)
-        user_similarities = self.user_similarity_matrix[user_idx]
-        similar_user_indices = np.argsort(user_similarities)[::-1][1:]  # Exclude self
+        predictable = total_similarities > 0
+        scores[predictable] = weighted_sums[predictable] / total_similarities[predictable]
         
-        # Get books rated by similar users but not by target user
-        user_ratings = self.user_book_matrix.loc[user_id]
-        unrated_books = user_ratings[user_ratings == 0].index.tolist()
+        # Exclude books the users have already rated
+        rated_rows, rated_cols = user_ratings.nonzero()
+        scores[rated_rows, rated_cols] = np.nan
+        return scores
+    
+    def _factor_score_block(self, user_indices):
+        """
+        Matrix factorization scores for a block of users: one product of their
+        factor vectors with the book factors. NaN where already rated.
+        """
+        matrix = self.user_book_matrix
+        user_indices = np.asarray(user_indices, dtype=np.int64)
+        if self.user_factors is None:
+            return np.full((len(user_indices), matrix.shape[1]), np.nan)
         
-        # Calculate predicted ratings for unrated books
-        book_scores = {}
-        for book_id in unrated_books:
-            if book_id not in self.book_ids:
-                continue
-            
-            # Weighted average of ratings from similar users
-            total_similarity = 0
-            weighted_sum = 0
-            
-            for similar_user_idx in similar_user_indices[:10]:  # Top 10 similar users
-                similar_user_id = self.user_ids[similar_user_idx]
-                similarity = user_similarities[similar_user_idx]
-                
-                if similarity <= 0:
-                    continue
-                
-                similar_user_rating = self.user_book_matrix.loc[similar_user_id, book_id]
-                if similar_user_rating > 0:
-                    weighted_sum += similarity * similar_user_rating
-                    total_similarity += similarity
-            
-            if total_similarity > 0:
-                book_scores[book_id] = weighted_sum / total_similarity
+        scores = self.user_factors[user_indices] @ self.item_factors.T
+        rated_rows, rated_cols = self._rating_rows(user_indices).nonzero()
+        scores[rated_rows, rated_cols] = np.nan
+        return scores
+    
+    def _catalog_row_map(self):
+        """
+        The catalog row of every user-book matrix column (-1 if the book is
+        not in the catalog), and the same mapping as a sparse (columns x
+        catalog rows) 0/1 matrix that moves column-aligned data to catalog
+        rows. Cached until books are added to or removed from the catalog,
+        or columns are added.
+        """
+        key = (self.catalog, self.catalog.rows_version, len(self.book_ids))
+        if self._catalog_rows is None or self._catalog_rows[0] != key:
+            rows = np.array([self.catalog.id_to_idx.get(book_id, -1) for book_id in self.book_ids.tolist()],
+                            dtype=np.int64)
+            in_catalog = np.flatnonzero(rows >= 0)
+            projection = sparse.csr_matrix(
+                (np.ones(len(in_catalog)), (in_catalog, rows[in_catalog])),
+                shape=(len(rows), len(self.catalog.book_ids))
+            )
+            self._catalog_rows = (key, rows, projection)
+        return self._catalog_rows[1], self._catalog_rows[2]
+    
+    def _filter_masks(self, filters):
+        """
+        Boolean masks of the books matching ``filters`` (keyword arguments of
+        BookCatalog.mask()) as ``(collaborative, content)``: one aligned with
+        the columns of the user-book matrix and one with the catalog rows.
+        Returns (None, None) without filters.
+        """
+        if not filters:
+            return None, None
+        with self._lock, STAGE_SECONDS.time(stage='filter_masks'):
+            content_mask = self.catalog.mask(**filters)
+            rows, _ = self._catalog_row_map()
+            collaborative_mask = np.zeros(len(rows), dtype=bool)
+            in_catalog = (rows >= 0) & (rows < len(content_mask))
+            collaborative_mask[in_catalog] = content_mask[rows[in_catalog]]
+            return collaborative_mask, content_mask
+    
+    def _collaborative_recommendations(self, user_id, n_recommendations=10, mask=None):
+        """
+        Get recommendations using collaborative filtering, only among the
+        books selected by ``mask`` (aligned with ``self.book_ids``) if given
+        """
+        if self.user_book_matrix is None or user_id not in self.user_id_to_idx:
+            return []
         
-        # Sort by predicted rating
-        sorted_books = sorted(book_scores.items(), key=lambda x: x[1], reverse=True)
-        return [book_id for book_id, score in sorted_books[:n_recommendations]]
+        with self._lock, STAGE_SECONDS.time(stage='collaborative_scores'):
+            scores = self._collaborative_scores(self.user_id_to_idx[user_id])
+            if mask is not None:
+                _apply_mask(scores, mask)
+            top_cols = _top_n_indices(scores, n_recommendations)
+            return self.book_ids[top_cols].tolist()
     
-    def _content_based_recommendations(self, user_id, n_recommendations=10):
-        """Get recommendations using content-based filtering"""
-        from models import Rating, Book
-        if self.content_similarity_matrix is None:
+    def _content_based_recommendations(self, user_id, n_recommendations=10, mask=None):
+        """
+        Get recommendations using content-based filtering, only among the
+        books selected by ``mask`` (aligned with the catalog rows) if given
+        """
+        from models import Rating
+        if self.content_neighbor_indices is None:
             return []
         
         # Get books the user has rated highly (4 or 5 stars)
-        user_ratings = Rating.query.filter_by(user_id=user_id).filter(Rating.rating >= 4).all()
+        with STAGE_SECONDS.time(stage='load_user_ratings'):
+            user_ratings = Rating.query.filter_by(user_id=user_id).filter(Rating.rating >= 4).all()
         if not user_ratings:
             return []
         
-        # Get all books
-        all_books = Book.query.all()
-        book_id_to_idx = {book.id: idx for idx, book in enumerate(all_books)}
-        
-        # Find similar books to highly rated books
-        book_scores = {}
-        rated_book_ids = {r.book_id for r in user_ratings}
-        
-        for rating in user_ratings:
-            book_id = rating.book_id
-            if book_id not in book_id_to_idx:
-                continue
+        with self._lock, STAGE_SECONDS.time(stage='content_scores'):
+            # Accumulate similarity x rating over the neighbours of each highly rated book
+            n_indexed = len(self.content_neighbor_indices)
+            scores = np.zeros(n_indexed)
+            candidates = np.zeros(n_indexed, dtype=bool)
+            rated_indices = []
+            for rating in user_ratings:
+                book_idx = self.catalog.id_to_idx.get(rating.book_id)
+                if book_idx is None or book_idx >= n_indexed:
+                    continue
+                rated_indices.append(book_idx)
+                neighbors = self.content_neighbor_indices[book_idx]
+                np.add.at(scores, neighbors, self.content_neighbor_scores[book_idx] * rating.rating)
+                candidates[neighbors] = True
             
-            book_idx = book_id_to_idx[book_id]
-            similarities = self.content_similarity_matrix[book_idx]
+            # Skip books already rated highly
+            candidates[rated_indices] = False
+            scores[~candidates] = np.nan
+            if mask is not None:
+                _apply_mask(scores, mask)
             
-            for idx, similarity in enumerate(similarities):
-                candidate_book_id = all_books[idx].id
-                
-                # Skip if already rated
-                if candidate_book_id in rated_book_ids:
-                    continue
-                
-                # Accumulate similarity scores
-                if candidate_book_id not in book_scores:
-                    book_scores[candidate_book_id] = 0
-                book_scores[candidate_book_id] += similarity * rating.rating
-        
-        # Sort by score
-        sorted_books = sorted(book_scores.items(), key=lambda x: x[1], reverse=True)
-        return [book_id for book_id, score in sorted_books[:n_recommendations]]
+            top_indices = _top_n_indices(scores, n_recommendations)
+            return self.catalog.book_ids[top_indices].tolist()
     
-    def get_hybrid_recommendations(self, user_id, n_recommendations=10, alpha=0.5):
+    def _content_neighbor_graphs(self):
         """
-        Get hybrid recommendations combining collaborative and content-based
+        The content neighbour index as sparse (books x books) matrices: one
+        holding similarities and one marking which pairs are neighbours.
+        Built on first use after training.
+        """
+        if self._content_graphs is None:
+            n_books, k = self.content_neighbor_indices.shape
+            indptr = np.arange(0, n_books * k + 1, k)
+            # Copies: the index arrays are updated in place by update_catalog()
+            indices = np.array(self.content_neighbor_indices).ravel()
+            similarities = sparse.csr_matrix(
+                (np.array(self.content_neighbor_scores, dtype=np.float64).ravel(), indices, indptr),
+                shape=(n_books, n_books)
+            )
+            neighbours = sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(n_books, n_books))
+            self._content_graphs = (similarities, neighbours)
+        return self._content_graphs
+    
+    def _content_score_block(self, user_ids):
+        """
+        Content-based scores for a block of users with one ratings query and
+        one sparse product. Returns a (len(user_ids), indexed books) array
+        with NaN for books that are not candidates, matching
+        _content_based_recommendations().
+        """
+        from models import db, Rating
+        n_indexed = len(self.content_neighbor_indices)
+        row_of_user = {user_id: row for row, user_id in enumerate(user_ids)}
         
-        Args:
-            user_id: User ID to get recommendations for
-            n_recommendations: Number of recommendations to return
-            alpha: Weight for collaborative filtering (1-alpha for content-based)
+        # Highly rated (4 or 5 stars) books of every user in the block
+        high_ratings = db.session.execute(
+            db.select(Rating.user_id, Rating.book_id, Rating.rating)
+            .where(Rating.user_id.in_(list(user_ids)), Rating.rating >= 4)
+        ).all()
+        rows, cols, values = [], [], []
+        for user_id, book_id, rating in high_ratings:
+            book_idx = self.catalog.id_to_idx.get(book_id)
+            if book_idx is not None and book_idx < n_indexed:
+                rows.append(row_of_user[user_id])
+                cols.append(book_idx)
+                values.append(rating)
+        liked = sparse.csr_matrix((values, (rows, cols)), shape=(len(user_ids), n_indexed), dtype=np.float64)
+        return self._content_scores_from_liked(liked)
+    
+    def _content_scores_from_liked(self, liked):
         """
-        # Get recommendations from both methods
-        collab_recs = self._collaborative_recommendations(user_id, n_recommendations * 2)
-        content_recs = self._content_based_recommendations(user_id, n_recommendations * 2)
+        Content-based scores from a sparse (users x indexed books) matrix of
+        highly rated books: similarity x rating summed over each liked book's
+        neighbours, NaN for books that are not candidates or already liked.
+        """
+        similarities, neighbours = self._content_neighbor_graphs()
+        scores = (liked @ similarities).toarray()
+        liked_pattern = liked.copy()
+        liked_pattern.data = np.ones(len(liked_pattern.data))
+        candidates = (liked_pattern @ neighbours).toarray() > 0
         
-        # Combine recommendations with weights
+        # Skip books already rated highly
+        candidates[liked.nonzero()] = False
+        scores[~candidates] = np.nan
+        return scores
+    
+    @staticmethod
+    def _fuse_rankings(collab_recs, content_recs, n_recommendations, alpha):
+        """Combine two ranked book id lists by weighted rank position"""
         book_scores = {}
         
         # Add collaborative filtering scores
@@ -205,56 +1192,428 @@ class HybridRecommender:
         
         # Sort by combined score
         sorted_books = sorted(book_scores.items(), key=lambda x: x[1], reverse=True)
-        recommended_book_ids = [book_id for book_id, score in sorted_books[:n_recommendations]]
+        return [book_id for book_id, score in sorted_books[:n_recommendations]]
+    
+    def _hybrid_score_block(self, user_indices, alpha, mask=None):
+        """
+        Score-level hybrid scores for a block of users (rows of the user-book
+        matrix), as a (len(user_indices), catalog rows) array.
         
-        # Get book details
-        from models import Book
-        recommendations = []
-        for book_id in recommended_book_ids:
-            book = Book.query.get(book_id)
-            if book:
-                recommendations.append({
-                    'id': book.id,
-                    'title': book.title,
-                    'author': book.author,
-                    'genre': book.genre,
-                    'description': book.description,
-                    'year': book.year,
-                    'rating': book.average_rating
-                })
+        Collaborative predictions and content scores are computed once each,
+        min-max normalized per user over the books that side can score, and
+        blended as alpha * collaborative + (1 - alpha) * content over the
+        union of both candidate sets (a book scored by one side only gets 0
+        from the other). The highly rated books feeding the content side come
+        from the user-book matrix, so no database queries are made. Books the
+        user rated, and books outside ``mask`` (catalog rows), are NaN.
+        """
+        user_indices = np.asarray(user_indices, dtype=np.int64)
+        n_rows = len(self.catalog.book_ids)
+        rows, projection = self._catalog_row_map()
+        in_catalog = np.flatnonzero(rows >= 0)
         
-        return recommendations
+        collaborative = np.full((len(user_indices), n_rows), np.nan)
+        collaborative[:, rows[in_catalog]] = self._collaborative_score_block(user_indices)[:, in_catalog]
+        
+        # The users' ratings moved from matrix columns to catalog rows
+        user_ratings = (self._rating_rows(user_indices) @ projection).tocsr()
+        content = np.full((len(user_indices), n_rows), np.nan)
+        if self.content_neighbor_indices is not None:
+            n_indexed = len(self.content_neighbor_indices)
+            liked = user_ratings[:, :n_indexed].tocsr()
+            liked.data[liked.data < 4] = 0  # Highly rated (4 or 5 stars) books only
+            liked.eliminate_zeros()
+            content[:, :n_indexed] = self._content_scores_from_liked(liked)
+        
+        _min_max_normalize(collaborative)
+        _min_max_normalize(content)
+        candidates = np.isfinite(collaborative) | np.isfinite(content)
+        scores = alpha * np.nan_to_num(collaborative) + (1 - alpha) * np.nan_to_num(content)
+        scores[~candidates] = np.nan
+        
+        # Exclude books the users have already rated, and removed books
+        scores[user_ratings.nonzero()] = np.nan
+        _apply_mask(scores, mask if mask is not None else self.catalog.mask())
+        return scores
     
-    def get_similar_books(self, book_id, n_recommendations=5):
-        """Get books similar to a given book using content-based similarity"""
-        from models import Book
-        if self.content_similarity_matrix is None:
-            return []
+    def get_hybrid_recommendations(self, user_id, n_recommendations=10, alpha=0.5, filters=None):
+        """
+        Get hybrid recommendations combining collaborative and content-based
         
-        all_books = Book.query.all()
-        book_id_to_idx = {book.id: idx for idx, book in enumerate(all_books)}
+        Args:
+            user_id: User ID to get recommendations for
+            n_recommendations: Number of recommendations to return
+            alpha: Weight for collaborative filtering (1-alpha for content-based)
+            filters: Only recommend books matching these keyword arguments of
+                BookCatalog.mask() (genres, authors, min_year, max_year);
+                applied to the scores before the top-k selection
+        """
+        collab_mask, content_mask = self._filter_masks(filters)
+        if self.fusion == 'score':
+            if self.user_book_matrix is None or user_id not in self.user_id_to_idx:
+                return []
+            with self._lock, STAGE_SECONDS.time(stage='hybrid_scores'):
+                scores = self._hybrid_score_block([self.user_id_to_idx[user_id]], alpha, content_mask)[0]
+                top_rows = _top_n_indices(scores, n_recommendations)
+                return self.catalog.get_many(self.catalog.book_ids[top_rows].tolist())
         
-        if book_id not in book_id_to_idx:
-            return []
+        # Get recommendations from both methods
+        collab_recs = self._collaborative_recommendations(user_id, n_recommendations * 2, collab_mask)
+        content_recs = self._content_based_recommendations(user_id, n_recommendations * 2, content_mask)
+        with STAGE_SECONDS.time(stage='fusion'):
+            recommended_book_ids = self._fuse_rankings(collab_recs, content_recs, n_recommendations, alpha)
+            
+            # Get book details from the catalog cache
+            return self.catalog.get_many(recommended_book_ids)
+    
+    def get_batch_recommendations(self, user_ids, n_recommendations=10, alpha=0.5, block_size=256, filters=None):
+        """
+        Get hybrid recommendations for many users at once.
+        
+        Users are scored in blocks with sparse matrix products (with rank
+        fusion, plus one ratings query per block), giving the same results as
+        calling get_hybrid_recommendations() for each user.
+        
+        Args:
+            user_ids: User IDs to get recommendations for
+            n_recommendations: Number of recommendations per user
+            alpha: Weight for collaborative filtering (1-alpha for content-based)
+            block_size: Users scored together; bounds the dense score arrays
+                to block_size x books
+            filters: Only recommend books matching these keyword arguments of
+                BookCatalog.mask(), as in get_hybrid_recommendations()
+        
+        Returns:
+            Dict of user ID -> list of recommended book IDs, best first
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        n_candidates = n_recommendations * 2
+        collab_mask, content_mask = self._filter_masks(filters)
+        results = {}
+        
+        for start in range(0, len(user_ids), block_size):
+            block = user_ids[start:start + block_size]
+            if self.fusion == 'score':
+                results.update({user_id: [] for user_id in block})
+                known = [user_id for user_id in block if user_id in self.user_id_to_idx]
+                if self.user_book_matrix is None or not known:
+                    continue
+                with self._lock, STAGE_SECONDS.time(stage='batch_hybrid_scores'):
+                    scores = self._hybrid_score_block([self.user_id_to_idx[u] for u in known], alpha, content_mask)
+                    for user_id, row in zip(known, scores):
+                        results[user_id] = self.catalog.book_ids[_top_n_indices(row, n_recommendations)].tolist()
+                continue
+            
+            collab_recs = {user_id: [] for user_id in block}
+            content_recs = {user_id: [] for user_id in block}
+            
+            with self._lock, STAGE_SECONDS.time(stage='batch_collaborative_scores'):
+                known = [user_id for user_id in block if user_id in self.user_id_to_idx]
+                if self.user_book_matrix is not None and known:
+                    scores = self._collaborative_score_block([self.user_id_to_idx[u] for u in known])
+                    if collab_mask is not None:
+                        _apply_mask(scores, collab_mask)
+                    for user_id, row in zip(known, scores):
+                        collab_recs[user_id] = self.book_ids[_top_n_indices(row, n_candidates)].tolist()
+            
+            if self.content_neighbor_indices is not None:
+                with self._lock, STAGE_SECONDS.time(stage='batch_content_scores'):
+                    scores = self._content_score_block(block)
+                    if content_mask is not None:
+                        _apply_mask(scores, content_mask)
+                    for user_id, row in zip(block, scores):
+                        content_recs[user_id] = self.catalog.book_ids[_top_n_indices(row, n_candidates)].tolist()
+            
+            for user_id in block:
+                results[user_id] = self._fuse_rankings(
+                    collab_recs[user_id], content_recs[user_id], n_recommendations, alpha
+                )
+        
+        return results
+    
+    def get_similar_books(self, book_id, n_recommendations=5, filters=None):
+        """
+        Get books similar to a given book using content-based similarity.
         
-        book_idx = book_id_to_idx[book_id]
-        similarities = self.content_similarity_matrix[book_idx]
+        ``filters`` (keyword arguments of BookCatalog.mask()) restrict the
+        result to matching books. The book's indexed neighbours are used when
+        enough of them match; otherwise the book is scored against every
+        matching book, since the index only keeps the top content_neighbors.
+        """
+        with self._lock:
+            if self.content_neighbor_indices is None:
+                return []
+            book_idx = self.catalog.id_to_idx.get(book_id)
+            if book_idx is None or book_idx >= len(self.content_neighbor_indices):
+                return []
+            
+            # Neighbours are stored most similar first (excluding the book itself)
+            neighbor_indices = self.content_neighbor_indices[book_idx]
+            neighbor_scores = self.content_neighbor_scores[book_idx]
+            if filters:
+                mask = self.catalog.mask(**filters)
+                keep = mask[neighbor_indices]
+                neighbor_indices, neighbor_scores = neighbor_indices[keep], neighbor_scores[keep]
+            neighbor_indices = np.array(neighbor_indices[:n_recommendations])
+            neighbor_scores = np.array(neighbor_scores[:n_recommendations])
+            weights = self._content_matrix()
         
-        # Get most similar books (excluding the book itself)
-        similar_indices = np.argsort(similarities)[::-1][1:n_recommendations+1]
+        if filters and len(neighbor_indices) < n_recommendations and weights is not None:
+            with STAGE_SECONDS.time(stage='filtered_similar_books'):
+                neighbor_indices, neighbor_scores = self._masked_similar_rows(
+                    book_idx, mask, n_recommendations, weights
+                )
         
         recommendations = []
-        for idx in similar_indices:
-            book = all_books[idx]
-            recommendations.append({
-                'id': book.id,
-                'title': book.title,
-                'author': book.author,
-                'genre': book.genre,
-                'description': book.description,
-                'year': book.year,
-                'rating': book.average_rating,
-                'similarity': float(similarities[idx])
-            })
+        for similar_id, similarity in zip(self.catalog.book_ids[neighbor_indices].tolist(), neighbor_scores):
+            book = self.catalog.get(similar_id)
+            if book is None:
+                continue
+            recommendations.append(dict(book, similarity=float(similarity)))
         
         return recommendations
+    
+    def _content_matrix(self):
+        """
+        L2-normalized content features of the indexed catalog rows: the
+        hashed weights (kept up to date by update_catalog()) or the TF-IDF
+        matrix from training
+        """
+        if self.content_features is not None:
+            return self.content_features.weights()
+        return self.tfidf_matrix
+    
+    def _masked_similar_rows(self, book_idx, mask, n_recommendations, weights):
+        """
+        Catalog rows selected by ``mask`` most similar to row ``book_idx``
+        and their similarities, best first, from the content feature rows
+        ``weights`` (see _content_matrix())
+        """
+        candidates = np.flatnonzero(mask[:weights.shape[0]])
+        candidates = candidates[candidates != book_idx]
+        query, features = weights[book_idx], weights[candidates]
+        similarities = np.asarray(safe_sparse_dot(features, query.T, dense_output=True)).ravel()
+        top = _top_n_indices(similarities, n_recommendations)
+        return candidates[top], similarities[top]
+    
+    def save(self, path):
+        """
+        Save the trained model to a versioned snapshot directory.
+        
+        Arrays are written as individual .npy files so they can be
+        memory-mapped by load(); the snapshot is written to a temporary
+        directory first and moved into place, so readers never see a
+        partially written snapshot.
+        
+        Only collecting the arrays holds the model lock; the files are
+        written without it, so live updates are not blocked on disk I/O.
+        Arrays that apply_rating() and update_catalog() modify in place are
+        copied, the others are only ever replaced.
+        """
+        with self._lock:
+            arrays = {
+                'user_ids': self.user_ids,
+                'book_ids': self.book_ids,
+            }
+            if self.user_book_matrix is not None:
+                ratings = self._merged_ratings()
+                arrays.update({
+                    'user_book_data': np.array(ratings.data),
+                    'user_book_indices': ratings.indices,
+                    'user_book_indptr': ratings.indptr,
+                    'user_norms': np.array(self.user_norms),
+                })
+            if self.user_neighbor_indices is not None:
+                arrays['user_neighbor_indices'] = self.user_neighbor_indices
+                arrays['user_neighbor_scores'] = self.user_neighbor_scores
+                if len(self._overlay_users):
+                    arrays['user_similarity_overlay'] = np.array(self._similarity_overlay[:len(self._overlay_users)])
+                    arrays['user_similarity_overlay_users'] = self._overlay_users
+            if self.item_neighbor_indices is not None:
+                arrays['item_neighbor_indices'] = self.item_neighbor_indices
+                arrays['item_neighbor_scores'] = self.item_neighbor_scores
+            if self.user_factors is not None:
+                arrays['user_factors'] = np.array(self.user_factors)
+                arrays['item_factors'] = self.item_factors
+            if self.content_neighbor_indices is not None:
+                arrays['content_neighbor_indices'] = np.array(self.content_neighbor_indices)
+                arrays['content_neighbor_scores'] = np.array(self.content_neighbor_scores)
+            
+            vectorizer = None
+            if self.vectorizer is not None:
+                vectorizer = {
+                    'vocabulary': {term: int(idx) for term, idx in self.vectorizer.vocabulary_.items()},
+                }
+                arrays['vectorizer_idf'] = self.vectorizer.idf_
+            if self.tfidf_matrix is not None:
+                arrays.update({
+                    'tfidf_data': self.tfidf_matrix.data,
+                    'tfidf_indices': self.tfidf_matrix.indices,
+                    'tfidf_indptr': self.tfidf_matrix.indptr,
+                })
+            
+            content_features = None
+            if self.content_features is not None:
+                counts = self.content_features.counts
+                content_features = {
+                    'n_features': self.content_features.n_features,
+                    'n_documents': self.content_features.n_documents,
+                }
+                arrays.update({
+                    'content_counts_data': counts.data,
+                    'content_counts_indices': counts.indices,
+                    'content_counts_indptr': counts.indptr,
+                    'content_document_frequencies': np.array(self.content_features.document_frequencies),
+                    'content_idf': self.content_features.idf_,
+                })
+            
+            metadata = {
+                'format_version': SNAPSHOT_FORMAT_VERSION,
+                'trained_at': self.trained_at,
+                'n_neighbors': self.n_neighbors,
+                'content_neighbors': self.content_neighbors,
+                'content_index': self.content_index,
+                'block_size': self.block_size,
+                'collaborative': self.collaborative,
+                'item_neighbors': self.item_neighbors,
+                'factorization': self.factorization,
+                'n_factors': self.n_factors,
+                'n_jobs': self.n_jobs,
+                'content_vectorizer': self.content_vectorizer,
+                'fusion': self.fusion,
+                'user_book_shape': list(self.user_book_matrix.shape) if self.user_book_matrix is not None else None,
+                'arrays': sorted(arrays),
+                'catalog_version': self.catalog.version,
+                'vectorizer': vectorizer,
+                'content_features': content_features,
+            }
+            catalog_rows = self.catalog.rows()
+        
+        path = os.path.abspath(path)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp_path)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(array))
+        with open(os.path.join(tmp_path, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+        with open(os.path.join(tmp_path, 'catalog.json'), 'w') as f:
+            json.dump(catalog_rows, f)
+        
+        # Swap the new snapshot into place; processes that memory-mapped the
+        # old one keep their (unlinked) files until they reload
+        old_path = None
+        if os.path.exists(path):
+            old_path = f"{tmp_path}.old"
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+    
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a model saved with save().
+        
+        Args:
+            path: Snapshot directory
+            mmap: Memory-map the arrays (copy-on-write) instead of reading
+                them into memory, so several worker processes share one copy
+                of the model data through the page cache
+        """
+        with open(os.path.join(path, 'metadata.json')) as f:
+            metadata = json.load(f)
+        version = metadata.get('format_version')
+        if version != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format version: {version}")
+        
+        mmap_mode = 'c' if mmap else None
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in metadata['arrays']
+        }
+        
+        model = cls(
+            n_neighbors=metadata['n_neighbors'],
+            content_neighbors=metadata['content_neighbors'],
+            content_index=metadata['content_index'],
+            block_size=metadata['block_size'],
+            collaborative=metadata.get('collaborative', 'user'),
+            item_neighbors=metadata.get('item_neighbors', 50),
+            factorization=metadata.get('factorization', 'als'),
+            n_factors=metadata.get('n_factors', 32),
+            n_jobs=metadata.get('n_jobs', 1),
+            content_vectorizer=metadata.get('content_vectorizer', 'tfidf'),
+            fusion=metadata.get('fusion', 'score')
+        )
+        model.trained_at = metadata['trained_at']
+        model.user_ids = arrays['user_ids']
+        model.book_ids = arrays['book_ids']
+        with open(os.path.join(path, 'catalog.json')) as f:
+            model.catalog = BookCatalog(json.load(f), version=metadata['catalog_version'])
+        model.user_id_to_idx = {int(uid): idx for idx, uid in enumerate(model.user_ids)}
+        model.book_id_to_idx = {int(bid): idx for idx, bid in enumerate(model.book_ids)}
+        
+        if metadata['user_book_shape'] is not None:
+            model.user_book_matrix = sparse.csr_matrix(
+                (arrays['user_book_data'], arrays['user_book_indices'], arrays['user_book_indptr']),
+                shape=tuple(metadata['user_book_shape']),
+                copy=False
+            )
+            model.user_norms = arrays['user_norms']
+            if 'user_neighbor_indices' in arrays:
+                model.user_neighbor_indices = arrays['user_neighbor_indices']
+                model.user_neighbor_scores = arrays['user_neighbor_scores']
+            elif 'user_similarity_matrix' in arrays:
+                # Snapshots saved with the full similarity matrix
+                model.user_neighbor_indices, model.user_neighbor_scores = _matrix_top_k(
+                    arrays['user_similarity_matrix'], USER_NEIGHBOR_FACTOR * model.n_neighbors, model.block_size
+                )
+            if 'user_similarity_overlay' in arrays:
+                # Rows rewritten by apply_rating() since training; read into memory
+                model._overlay_users = np.array(arrays['user_similarity_overlay_users'], dtype=np.int64)
+                model._similarity_overlay = np.array(arrays['user_similarity_overlay'])
+                model._similarity_slots = np.full(len(model.user_ids), -1, dtype=np.int64)
+                model._similarity_slots[model._overlay_users] = np.arange(len(model._overlay_users))
+        model.item_neighbor_indices = arrays.get('item_neighbor_indices')
+        model.item_neighbor_scores = arrays.get('item_neighbor_scores')
+        model.user_factors = arrays.get('user_factors')
+        model.item_factors = arrays.get('item_factors')
+        model.content_neighbor_indices = arrays.get('content_neighbor_indices')
+        model.content_neighbor_scores = arrays.get('content_neighbor_scores')
+        
+        if metadata['vectorizer'] is not None:
+            model.vectorizer = TfidfVectorizer(
+                stop_words='english',
+                vocabulary=metadata['vectorizer']['vocabulary']
+            )
+            model.vectorizer.idf_ = np.asarray(arrays['vectorizer_idf'])
+            n_indexed = len(model.content_neighbor_indices)
+            if 'tfidf_data' in arrays:
+                model.tfidf_matrix = sparse.csr_matrix(
+                    (arrays['tfidf_data'], arrays['tfidf_indices'], arrays['tfidf_indptr']),
+                    shape=(n_indexed, len(model.vectorizer.vocabulary))
+                )
+            else:
+                # Snapshots saved before the matrix was stored
+                model.tfidf_matrix = model.vectorizer.transform([
+                    book_text(book) if book else '' for book in model.catalog.rows()[:n_indexed]
+                ]).tocsr()
+        
+        content_features = metadata.get('content_features')
+        if content_features is not None:
+            # Read into memory: update_catalog() rewrites these in place
+            features = IncrementalTfidf(n_features=content_features['n_features'])
+            features.counts = sparse.csr_matrix(
+                (np.array(arrays['content_counts_data']), np.array(arrays['content_counts_indices']),
+                 np.array(arrays['content_counts_indptr'])),
+                shape=(len(arrays['content_counts_indptr']) - 1, content_features['n_features'])
+            )
+            features.document_frequencies = np.array(arrays['content_document_frequencies'])
+            features.n_documents = content_features['n_documents']
+            if 'content_idf' in arrays:
+                features.idf_ = np.array(arrays['content_idf'])
+            else:
+                features.idf_ = features.idf()
+            model.content_features = features.reweigh()
+        
+        return model
@@ -0,0 +1,85 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import CACHE_REQUESTS
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache with a time-to-live for computed API results.
+
+    Keys are tuples whose first element is a scope such as ``('user', 7)``;
+    the rest of the key carries everything the result depends on (request
+    parameters, model version, the user's rating version), so a stale entry
+    can never be hit. invalidate() additionally drops every entry of a scope
+    eagerly, and clear() drops everything, e.g. when a new model is published.
+
+    Args:
+        max_entries: Entries kept before the least recently used is evicted;
+            0 disables caching
+        ttl: Seconds an entry stays valid
+        name: Label for the cache hit/miss metrics
+    """
+
+    def __init__(self, max_entries=10000, ttl=300, name='responses'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.name = name
+        self._entries = OrderedDict()
+        self._scopes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the cached value for ``key``, or None if missing or expired"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= now:
+                self._discard(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        CACHE_REQUESTS.inc(cache=self.name, result='miss' if entry is None else 'hit')
+        return entry[0] if entry is not None else None
+
+    def set(self, key, value):
+        """Store ``value`` under ``key``, evicting the least recently used entries"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._scopes.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, scope):
+        """Drop every entry whose key starts with ``scope``"""
+        with self._lock:
+            for key in list(self._scopes.get(scope, ())):
+                self._discard(key)
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._entries.clear()
+            self._scopes.clear()
+
+    def _discard(self, key):
+        if self._entries.pop(key, None) is None:
+            return
+        keys = self._scopes.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._scopes[key[0]]
+
+
+def make_etag(*parts):
+    """Stable entity tag for a response derived from ``parts``"""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
@@ -5,6 +5,11 @@ const API_BASE = '/api';
 let currentUser = null;
 let allBooks = [];
 let users = [];
+let nextBooksAfter = null;
+
+// Books per page of the catalog listing; cards don't show the description
+const BOOKS_PAGE_SIZE = 60;
+const BOOK_CARD_FIELDS = 'id,title,author,genre,year,rating';
 
 // Initialize the app
 document.addEventListener('DOMContentLoaded', () => {
@@ -19,6 +24,7 @@ function setupEventListeners() {
     const getRecsBtn = document.getElementById('get-recommendations');
     const modal = document.getElementById('book-modal');
     const closeBtn = document.querySelector('.close');
+    const loadMoreBtn = document.getElementById('load-more-books');
 
     userSelect.addEventListener('change', (e) => {
         currentUser = e.target.value;
@@ -31,6 +37,10 @@ function setupEventListeners() {
         }
     });
 
+    loadMoreBtn.addEventListener('click', () => {
+        loadAllBooks(nextBooksAfter);
+    });
+
     closeBtn.addEventListener('click', () => {
         modal.classList.add('hidden');
     });
@@ -42,31 +52,53 @@ function setupEventListeners() {
     });
 }
 
-// Load users
+// Load users, one page at a time
 async function loadUsers() {
     try {
-        const response = await fetch(`${API_BASE}/users`);
-        users = await response.json();
-        
         const userSelect = document.getElementById('user-select');
-        users.forEach(user => {
-            const option = document.createElement('option');
-            option.value = user.id;
-            option.textContent = user.username;
-            userSelect.appendChild(option);
-        });
+        let after = null;
+        do {
+            const params = new URLSearchParams({ limit: 1000 });
+            if (after !== null) {
+                params.set('after', after);
+            }
+            const response = await fetch(`${API_BASE}/users?${params}`);
+            const page = await response.json();
+            
+            page.users.forEach(user => {
+                const option = document.createElement('option');
+                option.value = user.id;
+                option.textContent = user.username;
+                userSelect.appendChild(option);
+            });
+            users = users.concat(page.users);
+            after = page.next_after;
+        } while (after !== null);
     } catch (error) {
         console.error('Error loading users:', error);
         alert('Failed to load users');
     }
 }
 
-// Load all books
-async function loadAllBooks() {
+// Load the next page of books (the first page when after is null)
+async function loadAllBooks(after = null) {
     try {
-        const response = await fetch(`${API_BASE}/books`);
-        allBooks = await response.json();
-        displayBooks(allBooks, 'all-books');
+        const params = new URLSearchParams({ limit: BOOKS_PAGE_SIZE, fields: BOOK_CARD_FIELDS });
+        if (after !== null) {
+            params.set('after', after);
+        }
+        const response = await fetch(`${API_BASE}/books?${params}`);
+        const page = await response.json();
+        
+        allBooks = allBooks.concat(page.books);
+        if (after === null) {
+            displayBooks(page.books, 'all-books');
+        } else {
+            appendBooks(page.books, 'all-books');
+        }
+        
+        nextBooksAfter = page.next_after;
+        document.getElementById('load-more-books').classList.toggle('hidden', nextBooksAfter === null);
     } catch (error) {
         console.error('Error loading books:', error);
         alert('Failed to load books');
@@ -78,6 +110,9 @@ async function loadRecommendations(userId) {
     try {
         const response = await fetch(`${API_BASE}/users/${userId}/recommendations`);
         const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || `HTTP ${response.status}`);
+        }
         
         const recsSection = document.getElementById('recommendations-section');
         recsSection.classList.remove('hidden');
@@ -102,6 +137,12 @@ function displayBooks(books, containerId) {
         return;
     }
 
+    appendBooks(books, containerId);
+}
+
+// Add book cards to the end of a grid
+function appendBooks(books, containerId) {
+    const container = document.getElementById(containerId);
     books.forEach(book => {
         const bookCard = createBookCard(book);
         container.appendChild(bookCard);
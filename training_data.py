@@ -0,0 +1,60 @@
+"""
+Column-only loaders for model training.
+
+Training only needs a few columns, so these select them directly and stream
+the result in chunks instead of hydrating an ORM object per row. Ratings go
+straight into typed NumPy arrays, which keeps peak memory close to the size
+of the final arrays. All loaders must run inside an application context.
+"""
+import numpy as np
+
+from models import db, Book, Rating
+
+DEFAULT_CHUNK_SIZE = 100000
+
+
+def load_rating_arrays(since=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Load ratings as ``(user_ids, book_ids, ratings)`` arrays.
+
+    Args:
+        since: Only load ratings created or changed at or after this (naive
+            UTC) datetime.
+        chunk_size: Rows fetched per round trip
+
+    Returns:
+        int32 user and book id arrays and an int8 rating array, aligned
+    """
+    stmt = db.select(Rating.user_id, Rating.book_id, Rating.rating)
+    if since is not None:
+        stmt = stmt.where(Rating.updated_at >= since)
+
+    user_chunks, book_chunks, rating_chunks = [], [], []
+    result = db.session.execute(stmt.execution_options(yield_per=chunk_size))
+    for rows in result.partitions():
+        chunk = np.array(rows, dtype=np.int32).reshape(-1, 3)
+        user_chunks.append(chunk[:, 0].copy())
+        book_chunks.append(chunk[:, 1].copy())
+        rating_chunks.append(chunk[:, 2].astype(np.int8))
+
+    if not user_chunks:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int8)
+    return np.concatenate(user_chunks), np.concatenate(book_chunks), np.concatenate(rating_chunks)
+
+
+def count_ratings(since=None):
+    """Number of ratings, or of those created or changed at or after ``since``"""
+    stmt = db.select(db.func.count()).select_from(Rating)
+    if since is not None:
+        stmt = stmt.where(Rating.updated_at >= since)
+    return db.session.execute(stmt).scalar_one()
+
+
+def iter_book_rows(chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield every book, ordered by id, as the dict Book.to_dict() would return"""
+    fields = [field for field, _ in Book.SERIALIZED_FIELDS]
+    stmt = db.select(*(getattr(Book, attr) for _, attr in Book.SERIALIZED_FIELDS)).order_by(Book.id)
+    result = db.session.execute(stmt.execution_options(yield_per=chunk_size))
+    for rows in result.partitions():
+        for row in rows:
+            yield dict(zip(fields, row))